@@ -1,24 +1,26 @@
 
 import os
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Tuple
 from pydantic import BaseModel
 import numpy as np
-from sentence_transformers import SentenceTransformer
-import faiss
 import json
-import pandas as pd
+import hashlib
 import logging
+from collections import Counter
+
+from app.embeddings import get_embedding_model
+from app.hybrid_search import BM25Index, MetadataIndex, reciprocal_rank_fusion
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load embedding model
-try:
-    embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-except Exception as e:
-    logger.error(f"Error loading embedding model: {str(e)}")
-    embedding_model = None
+# The embedding model and FAISS are imported lazily (see app/embeddings.py),
+# so workers that never touch RAG don't pay for torch at startup
+
+def content_hash(content: str) -> str:
+    """Stable hash of document content, used to skip re-embedding identical text"""
+    return hashlib.sha256(" ".join(content.split()).encode("utf-8")).hexdigest()
 
 class Document(BaseModel):
     """Class for representing a document in the knowledge base"""
@@ -27,54 +29,279 @@ class Document(BaseModel):
     metadata: Dict[str, Any] = {}
     embedding: Optional[List[float]] = None
 
+# How many results each ranker contributes before reciprocal rank fusion
+HYBRID_CANDIDATE_MULTIPLIER = 4
+
+# Filtered vector searches score up to this many candidates directly;
+# larger candidate sets use an index search restricted by an ID selector
+FILTERED_RECONSTRUCT_LIMIT = 4096
+
 class KnowledgeBase:
-    """Class for managing the knowledge base with vector search capabilities"""
+    """Class for managing the knowledge base with vector, lexical and hybrid search"""
     def __init__(self, dimension: int = 384):
+        import faiss
         self.dimension = dimension
         self.index = faiss.IndexFlatL2(dimension)  # L2 distance index
         self.documents = {}
-        self.document_ids = []
+        self.document_ids = []  # FAISS row -> document id
+        self.rows_by_id = {}  # document id -> its current row
+        self.deleted_rows = set()  # rows of replaced or removed documents, dropped by compact()
+        self.content_hashes = Counter()  # content hash -> live documents with that content
+        
+        # Built alongside the FAISS index, keyed by the same row numbers
+        self.lexical_index = BM25Index()
+        self.metadata_index = MetadataIndex()
+    
+    def _index_document(self, row: int, document: Document):
+        """Add a document to the lexical and metadata indexes"""
+        self.lexical_index.add(row, document.content)
+        self.metadata_index.add(row, document.metadata)
     
     def add_document(self, document: Document):
         """Add a document to the knowledge base"""
-        if not document.embedding:
-            # Create embedding if not provided
-            if embedding_model:
-                document.embedding = embedding_model.encode(document.content).tolist()
-            else:
+        self.add_documents([document])
+    
+    def add_documents(self, documents: List[Document]):
+        """Add a batch of documents, embedding any that lack an embedding in one call"""
+        if not documents:
+            return
+        
+        missing = [doc for doc in documents if not doc.embedding]
+        if missing:
+            # Create embeddings if not provided
+            embedding_model = get_embedding_model()
+            if not embedding_model:
                 raise ValueError("Embedding model not loaded")
+            embeddings = embedding_model.encode([doc.content for doc in missing])
+            for doc, embedding in zip(missing, embeddings):
+                doc.embedding = embedding.tolist()
         
         # Add to index
-        embedding_array = np.array([document.embedding], dtype=np.float32)
+        embedding_array = np.array([doc.embedding for doc in documents], dtype=np.float32)
         self.index.add(embedding_array)
         
-        # Store document
-        self.documents[document.id] = document
-        self.document_ids.append(document.id)
+        # Store documents; an existing id is replaced and its old row tombstoned
+        for doc in documents:
+            if doc.id in self.rows_by_id:
+                self._tombstone(doc.id)
+            row = len(self.document_ids)
+            self._index_document(row, doc)
+            self.documents[doc.id] = doc
+            self.document_ids.append(doc.id)
+            self.rows_by_id[doc.id] = row
+            self.content_hashes[content_hash(doc.content)] += 1
+    
+    def _tombstone(self, doc_id: str):
+        """Take a document's current row out of every index"""
+        row = self.rows_by_id.pop(doc_id)
+        doc = self.documents[doc_id]
+        self.lexical_index.remove(row, doc.content)
+        self.metadata_index.remove(row, doc.metadata)
+        self.deleted_rows.add(row)
+        doc_hash = content_hash(doc.content)
+        self.content_hashes[doc_hash] -= 1
+        if self.content_hashes[doc_hash] <= 0:
+            del self.content_hashes[doc_hash]
     
-    def search(self, query: str, k: int = 5) -> List[Document]:
-        """Search the knowledge base for relevant documents"""
-        if not embedding_model:
-            raise ValueError("Embedding model not loaded")
+    def remove_documents(self, doc_ids):
+        """Remove documents by id; their vectors are dropped on the next compact()"""
+        for doc_id in doc_ids:
+            if doc_id in self.rows_by_id:
+                self._tombstone(doc_id)
+                del self.documents[doc_id]
+    
+    def source_document_ids(self, source_id: str) -> set:
+        """Ids of the live document or chunks ingested from one source document"""
+        doc_ids = {self.document_ids[row] for row in self.metadata_index.postings.get(("parent_id", source_id), ())}
+        if source_id in self.rows_by_id:
+            doc_ids.add(source_id)
+        return doc_ids
+    
+    def compact(self):
+        """Rebuild the indexes without tombstoned rows"""
+        if not self.deleted_rows:
+            return
+        import faiss
         
-        # Create query embedding
-        query_embedding = embedding_model.encode(query)
-        query_array = np.array([query_embedding], dtype=np.float32)
+        live_rows = [row for row in range(len(self.document_ids)) if row not in self.deleted_rows]
+        index = faiss.IndexFlatL2(self.dimension)
+        if live_rows:
+            index.add(self.index.reconstruct_batch(np.array(live_rows, dtype=np.int64)))
+        self.index = index
+        self.document_ids = [self.document_ids[row] for row in live_rows]
+        self._rebuild_row_indexes()
+    
+    def _rebuild_row_indexes(self):
+        """Rebuild row lookups and the lexical and metadata indexes from document_ids"""
+        self.rows_by_id = {}
+        self.deleted_rows = set()
+        self.lexical_index = BM25Index()
+        self.metadata_index = MetadataIndex()
+        for row, doc_id in enumerate(self.document_ids):
+            # Saves from before tombstoning could hold an id twice; the last row wins
+            if doc_id in self.rows_by_id:
+                previous = self.rows_by_id[doc_id]
+                self.lexical_index.remove(previous, self.documents[doc_id].content)
+                self.metadata_index.remove(previous, self.documents[doc_id].metadata)
+                self.deleted_rows.add(previous)
+            self.rows_by_id[doc_id] = row
+            self._index_document(row, self.documents[doc_id])
+    
+    def contains_content(self, content: str) -> bool:
+        """Check whether identical content has already been added"""
+        return content_hash(content) in self.content_hashes
+    
+    def search(
+        self,
+        query: str,
+        k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+        mode: str = "vector"
+    ) -> List[Document]:
+        """
+        Search the knowledge base for relevant documents.
+        
+        mode is "vector", "lexical" or "hybrid" (both fused with reciprocal rank fusion).
+        filters restrict results to documents whose metadata matches every field.
+        """
+        return self.search_batch([query], k=k, filters=[filters], mode=mode)[0]
+    
+    def search_batch(
+        self,
+        queries: List[str],
+        k: int = 5,
+        filters: Optional[List[Optional[Dict[str, Any]]]] = None,
+        mode: str = "vector",
+        query_embeddings: Optional[np.ndarray] = None
+    ) -> List[List[Document]]:
+        """Search the knowledge base for several queries with one encode and one index call"""
+        results = self.search_batch_scored(queries, k, filters, mode, query_embeddings)
+        return [[doc for _, doc in hits] for hits in results]
+    
+    def search_batch_scored(
+        self,
+        queries: List[str],
+        k: int = 5,
+        filters: Optional[List[Optional[Dict[str, Any]]]] = None,
+        mode: str = "vector",
+        query_embeddings: Optional[np.ndarray] = None
+    ) -> List[List[Tuple[float, Document]]]:
+        """
+        Like search_batch, but return (score, document) pairs where higher is better:
+        negative L2 distance for vector, BM25 for lexical and fused score for hybrid.
+        Pass query_embeddings to skip encoding when the caller already has them.
+        """
+        if mode not in ("vector", "lexical", "hybrid"):
+            raise ValueError(f"Unknown search mode: {mode}")
+        
+        filters = filters or [None] * len(queries)
+        fetch_k = k * HYBRID_CANDIDATE_MULTIPLIER if mode == "hybrid" else k
         
-        # Search index
-        distances, indices = self.index.search(query_array, k)
+        # Resolve metadata filters to candidate rows before any ranking
+        candidates = [
+            self.metadata_index.candidates(query_filters) if query_filters else None
+            for query_filters in filters
+        ]
+        
+        vector_hits = [[] for _ in queries]
+        if mode in ("vector", "hybrid"):
+            vector_hits = self._vector_search(queries, fetch_k, candidates, query_embeddings)
+        
+        lexical_hits = [[] for _ in queries]
+        if mode in ("lexical", "hybrid"):
+            lexical_hits = [
+                self.lexical_index.search(query, fetch_k, query_candidates)
+                for query, query_candidates in zip(queries, candidates)
+            ]
         
-        # Get documents
         results = []
-        for i in indices[0]:
-            if i < len(self.document_ids):
-                doc_id = self.document_ids[i]
-                results.append(self.documents[doc_id])
+        for vector_rows, lexical_rows in zip(vector_hits, lexical_hits):
+            if mode == "hybrid":
+                hits = reciprocal_rank_fusion([
+                    [row for row, _ in vector_rows],
+                    [row for row, _ in lexical_rows]
+                ])
+            elif mode == "vector":
+                hits = [(row, -distance) for row, distance in vector_rows]
+            else:
+                hits = lexical_rows
+            results.append([(score, self.documents[self.document_ids[row]]) for row, score in hits[:k]])
         
         return results
     
+    def _vector_search(
+        self,
+        queries: List[str],
+        k: int,
+        candidates: List[Optional[set]],
+        query_embeddings: Optional[np.ndarray] = None
+    ) -> List[List[Tuple[int, float]]]:
+        """Rank rows by L2 distance to each query embedding, returning (row, distance) pairs"""
+        if query_embeddings is None:
+            embedding_model = get_embedding_model()
+            if not embedding_model:
+                raise ValueError("Embedding model not loaded")
+            
+            # Create query embeddings in a single batch
+            query_embeddings = embedding_model.encode(queries)
+        query_array = np.asarray(query_embeddings, dtype=np.float32).reshape(len(queries), self.dimension)
+        
+        rankings = [[] for _ in queries]
+        
+        # Unfiltered queries share one index call
+        unfiltered = [i for i, query_candidates in enumerate(candidates) if query_candidates is None]
+        if unfiltered:
+            # Over-fetch past tombstoned rows until the next compact()
+            fetch_k = min(k + len(self.deleted_rows), max(self.index.ntotal, 1))
+            distances, indices = self.index.search(query_array[unfiltered], fetch_k)
+            # FAISS pads with -1 when the index holds fewer than k vectors
+            for i, row_distances, row_indices in zip(unfiltered, distances, indices):
+                rankings[i] = [
+                    (int(r), float(d))
+                    for r, d in zip(row_indices, row_distances)
+                    if 0 <= r < len(self.document_ids) and r not in self.deleted_rows
+                ][:k]
+        
+        # Filtered queries with few candidates reconstruct and score just those
+        # vectors; broad filters search the index restricted to the candidates
+        # instead of copying most of it per query
+        for i, query_candidates in enumerate(candidates):
+            if not query_candidates:
+                continue
+            rows = np.fromiter(query_candidates, dtype=np.int64, count=len(query_candidates))
+            if len(rows) > FILTERED_RECONSTRUCT_LIMIT:
+                rankings[i] = self._selector_search(query_array[i:i + 1], k, rows)
+                continue
+            vectors = self.index.reconstruct_batch(rows)
+            distances = ((vectors - query_array[i]) ** 2).sum(axis=1)
+            top = np.argsort(distances)[:k] if len(rows) <= k else np.argpartition(distances, k)[:k]
+            top = top[np.argsort(distances[top])]
+            rankings[i] = [(int(rows[j]), float(distances[j])) for j in top]
+        
+        return rankings
+    
+    def _selector_search(self, query: np.ndarray, k: int, rows: np.ndarray) -> List[Tuple[int, float]]:
+        """Search the index for one query, considering only the given rows"""
+        import faiss
+        
+        selector = faiss.IDSelectorBatch(len(rows), faiss.swig_ptr(rows))
+        distances, indices = self.index.search(query, k, params=faiss.SearchParameters(sel=selector))
+        return [(int(r), float(d)) for r, d in zip(indices[0], distances[0]) if r >= 0]
+    
+    def estimated_memory_bytes(self) -> int:
+        """Rough resident size of the index, documents and their embeddings"""
+        vector_bytes = self.index.ntotal * self.dimension * 4
+        # Embeddings are also kept on each Document as Python float lists (~32 bytes per value)
+        embedding_bytes = sum(len(doc.embedding or []) for doc in self.documents.values()) * 32
+        content_bytes = sum(len(doc.content) for doc in self.documents.values())
+        return vector_bytes + embedding_bytes + 2 * content_bytes
+    
     def save(self, filepath: str):
-        """Save the knowledge base to disk"""
+        """Save the knowledge base to disk, dropping tombstoned rows first"""
+        import faiss
+        
+        self.compact()
+        
         # Save index
         faiss.write_index(self.index, f"{filepath}.index")
         
@@ -92,12 +319,15 @@ class KnowledgeBase:
         with open(f"{filepath}.json", "w") as f:
             json.dump({
                 "documents": documents_data,
-                "document_ids": self.document_ids
+                "document_ids": self.document_ids,
+                "content_hashes": sorted(self.content_hashes.elements())
             }, f)
     
     @classmethod
     def load(cls, filepath: str):
         """Load knowledge base from disk"""
+        import faiss
+        
         # Create instance
         kb = cls()
         
@@ -117,9 +347,26 @@ class KnowledgeBase:
                 )
                 for doc_id, doc_data in data["documents"].items()
             }
+            # Older saves have no hashes; rebuild them from the documents
+            kb.content_hashes = Counter(data.get("content_hashes") or (
+                content_hash(doc.content) for doc in kb.documents.values()
+            ))
+        
+        # Row lookups, lexical and metadata indexes are cheap to rebuild, so they aren't saved
+        kb._rebuild_row_indexes()
         
         return kb
 
+def pack_documents(documents: List[Document], count_tokens: Callable[[str], int], token_budget: int) -> List[Document]:
+    """Keep the highest-ranked documents that fit within the token budget"""
+    packed = []
+    for doc in documents:
+        tokens = count_tokens(f"Document {len(packed) + 1}:\n{doc.content}\n\n")
+        if tokens <= token_budget:
+            packed.append(doc)
+            token_budget -= tokens
+    return packed
+
 class RAGProcessor:
     """Retrieval-Augmented Generation processor"""
     def __init__(self, knowledge_base: KnowledgeBase):
@@ -130,12 +377,31 @@ class RAGProcessor:
         try:
             # Search for relevant documents
             relevant_docs = self.knowledge_base.search(query, k=k)
-            
-            # Create context string
-            context = "\n\n".join([f"Document {i+1}:\n{doc.content}" for i, doc in enumerate(relevant_docs)])
-            
-            # Create prompt with retrieved context
-            prompt = f"""
+            return self.build_prompt(query, relevant_docs)
+        except Exception as e:
+            logger.error(f"Error in RAG processing: {str(e)}")
+            return f"I'll help you answer: {query}"
+    
+    @staticmethod
+    def build_prompt(
+        query: str,
+        documents: List[Document],
+        count_tokens: Optional[Callable[[str], int]] = None,
+        token_budget: Optional[int] = None
+    ) -> str:
+        """Create the prompt with retrieved context, packed to a token budget if one is given"""
+        if count_tokens and token_budget is not None:
+            overhead = count_tokens(RAGProcessor._format_prompt(query, ""))
+            documents = pack_documents(documents, count_tokens, token_budget - overhead)
+        
+        # Create context string
+        context = "\n\n".join([f"Document {i+1}:\n{doc.content}" for i, doc in enumerate(documents)])
+        return RAGProcessor._format_prompt(query, context)
+    
+    @staticmethod
+    def _format_prompt(query: str, context: str) -> str:
+        """Create prompt with retrieved context"""
+        return f"""
             I'll provide you with some relevant information to help answer a question.
             
             Question: {query}
@@ -146,41 +412,6 @@ class RAGProcessor:
             Please provide a comprehensive answer to the question based on the information provided above.
             If the information doesn't contain the answer, say so clearly rather than making up information.
             """
-            
-            return prompt
-        except Exception as e:
-            logger.error(f"Error in RAG processing: {str(e)}")
-            return f"I'll help you answer: {query}"
 
-# Example usage of RAG in llm_service.py
-# We would modify process_message to use RAG when appropriate
-"""
-async def process_message(
-    llm_client: BaseLLMClient,
-    message_history: List[Dict[str, str]],
-    current_message: str,
-    use_rag: bool = True
-) -> str:
-    # Check if we should use RAG
-    if use_rag:
-        # Load knowledge base
-        kb = KnowledgeBase.load("path/to/knowledge_base")
-        rag_processor = RAGProcessor(kb)
-        
-        # Process query with RAG
-        enhanced_prompt = rag_processor.process_query(current_message)
-        
-        # Add enhanced prompt as system message
-        messages = message_history.copy()
-        messages.insert(0, {
-            "role": "system",
-            "content": enhanced_prompt
-        })
-        
-        # Generate response with enhanced context
-        response = await llm_client.generate_response(messages)
-        return response
-    else:
-        # Original processing without RAG
-        # ...
-"""
+# RAG runs as a stage of process_message in llm_service.py, using the resident
+# knowledge base from retrieval.py so the index is not reloaded per message
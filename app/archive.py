@@ -0,0 +1,224 @@
+import os
+import sys
+import glob
+import gzip
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Iterator, List
+
+import orjson
+
+from app.database import SessionLocal
+from app.models import Conversation, Message
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "data/archive")
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+EXPORT_BATCH_SIZE = 1000
+
+# Archives and exports share one NDJSON layout: a conversation record
+# followed by one record per message, oldest first
+def conversation_record(conv_id, title, created_at, updated_at) -> bytes:
+    return orjson.dumps({
+        "type": "conversation",
+        "id": conv_id,
+        "title": title,
+        "created_at": created_at,
+        "updated_at": updated_at
+    }) + b"\n"
+
+def message_record(msg_id, conversation_id, role, content, created_at, reply_to_id) -> bytes:
+    return orjson.dumps({
+        "type": "message",
+        "id": msg_id,
+        "conversation_id": conversation_id,
+        "role": role,
+        "content": content,
+        "created_at": created_at,
+        "reply_to_id": reply_to_id
+    }) + b"\n"
+
+def _archive_path(archive_dir: str, user_id: str, updated_at: datetime) -> str:
+    return os.path.join(archive_dir, user_id, f"{updated_at:%Y-%m}.ndjson.gz")
+
+def archive_cold_conversations(
+    db,
+    older_than_days: int = ARCHIVE_AFTER_DAYS,
+    archive_dir: str = ARCHIVE_DIR,
+    batch_size: int = 100
+) -> int:
+    """
+    Move conversations with no activity for older_than_days out of the
+    database into per-user, per-month gzip NDJSON files.
+
+    Each batch is locked (FOR UPDATE SKIP LOCKED where supported), so a
+    message posted meanwhile waits for the batch to commit and then finds
+    the conversation gone. Batches are appended as a new gzip member and
+    synced to disk before rows are deleted. Only the messages written to the
+    file are deleted, and only conversations that are still cold with no
+    other messages left. An interrupted run can at worst archive a
+    conversation twice, never lose it. Returns the number archived.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archived = 0
+    kept = set()  # conversations that turned out not to be archivable this run
+
+    while True:
+        query = db.query(
+            Conversation.id, Conversation.user_id, Conversation.title,
+            Conversation.created_at, Conversation.updated_at
+        ).filter(
+            Conversation.updated_at < cutoff
+        )
+        if kept:
+            query = query.filter(~Conversation.id.in_(kept))
+        conversations = query.order_by(
+            Conversation.updated_at
+        ).limit(batch_size).with_for_update(skip_locked=True).all()
+        if not conversations:
+            db.rollback()
+            break
+
+        conversation_ids = [conv.id for conv in conversations]
+        messages_by_conversation = defaultdict(list)
+        archived_message_ids = []
+        for msg in db.query(
+            Message.id, Message.conversation_id, Message.role, Message.content,
+            Message.created_at, Message.reply_to_id
+        ).filter(
+            Message.conversation_id.in_(conversation_ids)
+        ).order_by(Message.conversation_id, Message.created_at, Message.id):
+            messages_by_conversation[msg.conversation_id].append(message_record(*msg))
+            archived_message_ids.append(msg.id)
+
+        chunks_by_path = defaultdict(list)
+        for conv in conversations:
+            path = _archive_path(archive_dir, conv.user_id, conv.updated_at)
+            chunks_by_path[path].append(
+                conversation_record(conv.id, conv.title, conv.created_at, conv.updated_at)
+            )
+            chunks_by_path[path].extend(messages_by_conversation[conv.id])
+
+        for path, chunks in chunks_by_path.items():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "ab") as f:
+                f.write(gzip.compress(b"".join(chunks)))
+                f.flush()
+                os.fsync(f.fileno())
+
+        # Re-check coldness: without row locks (SQLite) a conversation may have
+        # been posted to since the batch was read. Those stay, with all their messages
+        still_cold = {
+            conv_id for conv_id, in db.query(Conversation.id).filter(
+                Conversation.id.in_(conversation_ids),
+                Conversation.updated_at < cutoff
+            )
+        }
+        for start in range(0, len(archived_message_ids), 1000):
+            db.query(Message).filter(
+                Message.id.in_(archived_message_ids[start:start + 1000]),
+                Message.conversation_id.in_(still_cold)
+            ).delete(synchronize_session=False)
+
+        # A message inserted after the read (e.g. a late assistant reply) keeps its conversation
+        not_empty = {
+            conv_id for conv_id, in db.query(Message.conversation_id).filter(
+                Message.conversation_id.in_(still_cold)
+            ).distinct()
+        }
+        removable = still_cold - not_empty
+        db.query(Conversation).filter(
+            Conversation.id.in_(removable)
+        ).delete(synchronize_session=False)
+        db.commit()
+
+        kept.update(set(conversation_ids) - removable)
+        archived += len(removable)
+        logger.info(f"Archived {archived} conversations")
+
+    return archived
+
+def archive_files(user_id: str, archive_dir: str = ARCHIVE_DIR) -> List[str]:
+    """A user's archive files, oldest month first"""
+    return sorted(glob.glob(os.path.join(archive_dir, glob.escape(user_id), "*.ndjson.gz")))
+
+def iter_archived_records(user_id: str, archive_dir: str = ARCHIVE_DIR) -> Iterator[bytes]:
+    """Stream a user's archived NDJSON lines without decompressing whole files into memory"""
+    for path in archive_files(user_id, archive_dir):
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                yield line
+
+def iter_export(user_id: str, archive_dir: str = ARCHIVE_DIR) -> Iterator[bytes]:
+    """
+    Stream all of a user's conversations as NDJSON: archived ones first, then
+    those still in the database, read through a server-side cursor in
+    batches of EXPORT_BATCH_SIZE so memory stays flat however large the history.
+    """
+    buffer = []
+    buffered = 0
+
+    def flush():
+        nonlocal buffer, buffered
+        chunk = b"".join(buffer)
+        buffer = []
+        buffered = 0
+        return chunk
+
+    for line in iter_archived_records(user_id, archive_dir):
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= 64 * 1024:
+            yield flush()
+
+    # Uses its own session: the response streams after the request's session is closed
+    db = SessionLocal()
+    try:
+        rows = db.query(
+            Conversation.title, Conversation.created_at.label("conversation_created_at"),
+            Conversation.updated_at, Message.id, Message.conversation_id, Message.role,
+            Message.content, Message.created_at, Message.reply_to_id
+        ).join(
+            Conversation, Message.conversation_id == Conversation.id
+        ).filter(
+            Conversation.user_id == user_id
+        ).order_by(
+            Message.conversation_id, Message.created_at, Message.id
+        ).yield_per(EXPORT_BATCH_SIZE)
+
+        current_conversation = None
+        for row in rows:
+            if row.conversation_id != current_conversation:
+                current_conversation = row.conversation_id
+                line = conversation_record(
+                    row.conversation_id, row.title, row.conversation_created_at, row.updated_at
+                )
+                buffer.append(line)
+                buffered += len(line)
+            line = message_record(
+                row.id, row.conversation_id, row.role, row.content, row.created_at, row.reply_to_id
+            )
+            buffer.append(line)
+            buffered += len(line)
+            if buffered >= 64 * 1024:
+                yield flush()
+    finally:
+        db.close()
+
+    if buffer:
+        yield flush()
+
+if __name__ == "__main__":
+    # Usage: python -m app.archive [older_than_days] [archive_dir]
+    older_than_days = int(sys.argv[1]) if len(sys.argv) > 1 else ARCHIVE_AFTER_DAYS
+    archive_dir = sys.argv[2] if len(sys.argv) > 2 else ARCHIVE_DIR
+    db = SessionLocal()
+    try:
+        count = archive_cold_conversations(db, older_than_days, archive_dir)
+        logger.info(f"Archived {count} conversations older than {older_than_days} days to {archive_dir}")
+    finally:
+        db.close()
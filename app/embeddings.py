@@ -0,0 +1,183 @@
+import os
+import gc
+import sys
+import time
+import json
+import tempfile
+import threading
+import logging
+from multiprocessing.connection import Client, Listener
+from typing import List, Optional, Union
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "all-MiniLM-L6-v2")
+
+# When set, encoding is delegated to a single local embedding worker
+# (``python -m app.embeddings``) instead of loading the model in this process.
+# Accepts a Unix socket path or "host:port".
+EMBEDDING_WORKER_ADDRESS = os.getenv("EMBEDDING_WORKER_ADDRESS")
+DEFAULT_WORKER_SOCKET = os.path.join(tempfile.gettempdir(), "chatapp-embeddings.sock")
+# Shared secret for the worker handshake; both sides refuse to run without one
+EMBEDDING_WORKER_AUTHKEY = os.getenv("EMBEDDING_WORKER_AUTHKEY", "").encode()
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+# After a failed load, wait this long before trying again
+EMBEDDING_LOAD_RETRY_SECONDS = float(os.getenv("EMBEDDING_LOAD_RETRY_SECONDS", "60"))
+
+_model = None
+_model_lock = threading.Lock()
+_load_failed_at: Optional[float] = None
+
+def _parse_address(address: str):
+    """Turn "host:port" into a tuple, leave socket paths as they are"""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return (host or "127.0.0.1", int(port))
+    return address
+
+def _require_authkey(authkey: bytes) -> bytes:
+    if not authkey:
+        raise ValueError("EMBEDDING_WORKER_AUTHKEY must be set to use the embedding worker")
+    return authkey
+
+class RemoteEmbeddingModel:
+    """
+    Client for a shared local embedding worker, exposing the same encode() call.
+    Requests are sent as JSON and embeddings come back as raw float32 bytes;
+    nothing received from the socket is unpickled.
+    """
+    def __init__(self, address: str, authkey: bytes = EMBEDDING_WORKER_AUTHKEY):
+        self.address = _parse_address(address)
+        self.authkey = _require_authkey(authkey)
+        self._local = threading.local()
+
+    def _connection(self):
+        """One connection per thread, since connections are not thread-safe"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn.closed:
+            conn = Client(self.address, authkey=self.authkey)
+            self._local.conn = conn
+        return conn
+
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 32) -> np.ndarray:
+        """Encode sentences on the embedding worker"""
+        conn = self._connection()
+        try:
+            conn.send_bytes(json.dumps({"sentences": sentences, "batch_size": batch_size}).encode())
+            header = json.loads(conn.recv_bytes())
+            if header.get("status") != "ok":
+                raise RuntimeError(f"Embedding worker error: {header.get('error')}")
+            data = conn.recv_bytes()
+        except (EOFError, OSError):
+            conn.close()
+            raise
+        return np.frombuffer(data, dtype=np.float32).reshape(header["shape"])
+
+def _load_model():
+    """Import sentence-transformers (and torch) and build the model"""
+    from sentence_transformers import SentenceTransformer
+    logger.info(f"Loading embedding model {EMBEDDING_MODEL_NAME}")
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+def get_embedding_model():
+    """Return the embedding model, loading it on first use"""
+    global _model, _load_failed_at
+    if _model is not None:
+        return _model
+
+    # Don't queue every retrieval thread behind another doomed load
+    if _load_failed_at is not None and time.monotonic() - _load_failed_at < EMBEDDING_LOAD_RETRY_SECONDS:
+        return None
+
+    with _model_lock:
+        if _model is None:
+            if _load_failed_at is not None and time.monotonic() - _load_failed_at < EMBEDDING_LOAD_RETRY_SECONDS:
+                return None
+            try:
+                if EMBEDDING_WORKER_ADDRESS:
+                    _model = RemoteEmbeddingModel(EMBEDDING_WORKER_ADDRESS)
+                else:
+                    _model = _load_model()
+                _load_failed_at = None
+            except Exception as e:
+                logger.error(f"Error loading embedding model: {str(e)}")
+                _load_failed_at = time.monotonic()
+                return None
+    return _model
+
+def warm_up():
+    """Load the embedding model and run one encode so the first request is not slow"""
+    model = get_embedding_model()
+    if model is None:
+        return False
+    model.encode(["warm up"])
+    return True
+
+def preload_for_fork():
+    """
+    Load the model in the parent process before workers are forked
+    (e.g. gunicorn --preload), so its weights are shared copy-on-write.
+    """
+    if not warm_up():
+        return False
+    # Move everything allocated so far out of the GC's reach, otherwise the
+    # collector touches those objects in each child and un-shares their pages
+    gc.freeze()
+    logger.info("Embedding model preloaded for forked workers")
+    return True
+
+def _handle_connection(conn, model):
+    """Serve encode requests on one client connection"""
+    with conn:
+        while True:
+            try:
+                request = json.loads(conn.recv_bytes(MAX_REQUEST_BYTES))
+                sentences, batch_size = request["sentences"], int(request["batch_size"])
+            except (EOFError, OSError):
+                return
+            except (ValueError, KeyError, TypeError) as e:
+                conn.send_bytes(json.dumps({"status": "error", "error": f"Bad request: {str(e)}"}).encode())
+                continue
+            try:
+                embeddings = np.ascontiguousarray(
+                    model.encode(sentences, batch_size=batch_size), dtype=np.float32
+                )
+            except Exception as e:
+                conn.send_bytes(json.dumps({"status": "error", "error": str(e)}).encode())
+                continue
+            conn.send_bytes(json.dumps({"status": "ok", "shape": list(embeddings.shape)}).encode())
+            conn.send_bytes(embeddings.tobytes())
+
+def serve_embeddings(address: str = DEFAULT_WORKER_SOCKET, authkey: bytes = EMBEDDING_WORKER_AUTHKEY):
+    """Run a single embedding worker that all app workers on this host can share"""
+    authkey = _require_authkey(authkey)
+    parsed = _parse_address(address)
+    model = _load_model()
+
+    if isinstance(parsed, str) and os.path.exists(parsed):
+        os.unlink(parsed)  # stale socket from a previous run
+    # Create the Unix socket owner-only from the start (0600)
+    previous_umask = os.umask(0o177)
+    try:
+        listener = Listener(parsed, authkey=authkey)
+    finally:
+        os.umask(previous_umask)
+
+    with listener:
+        logger.info(f"Embedding worker listening on {address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                logger.error(f"Error accepting embedding client: {str(e)}")
+                continue
+            threading.Thread(target=_handle_connection, args=(conn, model), daemon=True).start()
+
+if __name__ == "__main__":
+    # Usage: EMBEDDING_WORKER_AUTHKEY=<secret> python -m app.embeddings [socket_path|host:port]
+    serve_embeddings(sys.argv[1] if len(sys.argv) > 1 else (EMBEDDING_WORKER_ADDRESS or DEFAULT_WORKER_SOCKET))
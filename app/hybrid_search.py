@@ -0,0 +1,140 @@
+import re
+import math
+import heapq
+from collections import defaultdict
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+# Keep codes like "E-1042" or "SKU_77.3" together as a single term
+_TERM_PATTERN = re.compile(r"\w+(?:[-.]\w+)*")
+
+# Constant from the original reciprocal rank fusion paper
+RRF_K = 60
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase terms for lexical search"""
+    return _TERM_PATTERN.findall(text.lower())
+
+class BM25Index:
+    """Inverted index scoring documents with Okapi BM25"""
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[int, int]] = defaultdict(dict)  # term -> {row: term frequency}
+        self.doc_lengths: Dict[int, int] = {}
+        self.total_length = 0
+
+    def add(self, row: int, text: str):
+        """Index the text of the document stored at the given row"""
+        terms = tokenize(text)
+        self.doc_lengths[row] = len(terms)
+        self.total_length += len(terms)
+        counts = defaultdict(int)
+        for term in terms:
+            counts[term] += 1
+        for term, count in counts.items():
+            self.postings[term][row] = count
+
+    def remove(self, row: int, text: str):
+        """Drop a row previously added with the given text"""
+        length = self.doc_lengths.pop(row, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for term in set(tokenize(text)):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(row, None)
+                if not postings:
+                    del self.postings[term]
+
+    def search(self, query: str, k: int = 5, candidates: Optional[Set[int]] = None) -> List[Tuple[int, float]]:
+        """Return the top-k (row, score) pairs, optionally restricted to candidate rows"""
+        if not self.doc_lengths:
+            return []
+
+        n_docs = len(self.doc_lengths)
+        avg_length = self.total_length / n_docs
+        scores = defaultdict(float)
+
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+
+            # Walk whichever side is smaller so filtered searches only touch matching rows
+            if candidates is not None and len(candidates) < len(postings):
+                matches = ((row, postings[row]) for row in candidates if row in postings)
+            elif candidates is not None:
+                matches = ((row, tf) for row, tf in postings.items() if row in candidates)
+            else:
+                matches = postings.items()
+
+            for row, tf in matches:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[row] / avg_length)
+                scores[row] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+class MetadataIndex:
+    """Per-field posting lists over document metadata, used to pre-filter searches"""
+    def __init__(self):
+        self.postings: Dict[Tuple[str, Hashable], Set[int]] = defaultdict(set)
+
+    def add(self, row: int, metadata: Dict[str, Any]):
+        """Index the metadata of the document stored at the given row"""
+        for field, value in metadata.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            for item in values:
+                if isinstance(item, Hashable):
+                    self.postings[(field, item)].add(row)
+
+    def remove(self, row: int, metadata: Dict[str, Any]):
+        """Drop a row previously added with the given metadata"""
+        for field, value in metadata.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            for item in values:
+                if isinstance(item, Hashable):
+                    rows = self.postings.get((field, item))
+                    if rows is not None:
+                        rows.discard(row)
+                        if not rows:
+                            del self.postings[(field, item)]
+
+    def candidates(self, filters: Dict[str, Any]) -> Set[int]:
+        """
+        Return the rows matching every filter. A filter value that is a list
+        matches any of its items.
+        """
+        matches = []
+        for field, value in filters.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            rows = set()
+            for item in values:
+                # Unhashable values were never indexed, so they match nothing
+                if isinstance(item, Hashable):
+                    try:
+                        rows |= self.postings.get((field, item), set())
+                    except TypeError:
+                        pass  # e.g. a tuple holding a list
+            matches.append(rows)
+
+        if not matches:
+            return set()
+
+        # Intersect smallest first to keep the working set small
+        matches.sort(key=len)
+        result = set(matches[0])
+        for rows in matches[1:]:
+            result &= rows
+            if not result:
+                break
+        return result
+
+def reciprocal_rank_fusion(rankings: Iterable[List[int]], k: int = RRF_K) -> List[Tuple[int, float]]:
+    """Merge several ranked lists of rows into one (row, score) ranking using reciprocal rank fusion"""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            scores[row] += 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,190 @@
+import os
+import re
+import sys
+import json
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.advanced_llm import Document, KnowledgeBase, content_hash
+from app.embeddings import get_embedding_model
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# all-MiniLM-L6-v2 truncates input at 256 word pieces, two of which are [CLS]/[SEP]
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "254"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+
+DEFAULT_EXTENSIONS = (".txt", ".md", ".rst")
+
+# Rough word-piece to whitespace-word ratio, used when no tokenizer is available
+_WORDS_PER_TOKEN = 0.75
+_WORD_PATTERN = re.compile(r"\S+")
+
+# Sources
+
+def iter_file(path: str, metadata: Optional[Dict[str, Any]] = None) -> Iterator[Document]:
+    """Yield a single text file as a document"""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        content = f.read()
+    yield Document(id=path, content=content, metadata={"source": path, **(metadata or {})})
+
+def iter_directory(path: str, extensions: Tuple[str, ...] = DEFAULT_EXTENSIONS) -> Iterator[Document]:
+    """Yield every matching text file under a directory, one at a time"""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(extensions):
+                yield from iter_file(os.path.join(root, name))
+
+def iter_ndjson(path: str) -> Iterator[Document]:
+    """Yield documents from a newline-delimited JSON file of {"id", "content", "metadata"} records"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                yield Document(
+                    id=str(record.get("id") or f"{path}:{line_number}"),
+                    content=record["content"],
+                    metadata=record.get("metadata") or {}
+                )
+            except (ValueError, KeyError) as e:
+                logger.error(f"Skipping invalid record at {path}:{line_number}: {str(e)}")
+
+def iter_source(path: str) -> Iterator[Document]:
+    """Pick a source reader based on what the path points to"""
+    if os.path.isdir(path):
+        return iter_directory(path)
+    if path.endswith((".ndjson", ".jsonl")):
+        return iter_ndjson(path)
+    return iter_file(path)
+
+# Chunking
+
+def _token_spans(text: str, tokenizer=None) -> List[Tuple[int, int]]:
+    """Return (start, end) character offsets of each token in the text"""
+    if tokenizer is not None:
+        try:
+            encoded = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+            return [tuple(span) for span in encoded["offset_mapping"]]
+        except Exception as e:
+            logger.error(f"Tokenizer failed, falling back to word spans: {str(e)}")
+    return [match.span() for match in _WORD_PATTERN.finditer(text)]
+
+def chunk_document(
+    document: Document,
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap: int = CHUNK_OVERLAP_TOKENS,
+    tokenizer=None
+) -> Iterator[Document]:
+    """Split a document into overlapping chunks that fit the embedding model's input window"""
+    if overlap >= max_tokens:
+        raise ValueError("Chunk overlap must be smaller than the chunk size")
+
+    if tokenizer is None:
+        # Whitespace words run longer than word pieces, so leave some headroom
+        max_tokens = max(1, int(max_tokens * _WORDS_PER_TOKEN))
+        overlap = min(overlap, max_tokens - 1)
+
+    spans = _token_spans(document.content, tokenizer)
+    if len(spans) <= max_tokens:
+        yield document
+        return
+
+    step = max_tokens - overlap
+    for chunk_index, start in enumerate(range(0, len(spans), step)):
+        window = spans[start:start + max_tokens]
+        yield Document(
+            id=f"{document.id}#{chunk_index}",
+            content=document.content[window[0][0]:window[-1][1]],
+            metadata={**document.metadata, "parent_id": document.id, "chunk": chunk_index}
+        )
+        if start + max_tokens >= len(spans):
+            break
+
+def chunk_documents(documents: Iterable[Document], **kwargs) -> Iterator[Document]:
+    """Lazily chunk a stream of documents"""
+    for document in documents:
+        yield from chunk_document(document, **kwargs)
+
+# Ingestion
+
+def _default_tokenizer():
+    """Use the embedding model's own tokenizer when it is loaded in this process"""
+    model = get_embedding_model()
+    return getattr(model, "tokenizer", None)
+
+def ingest(
+    documents: Iterable[Document],
+    knowledge_base: KnowledgeBase,
+    batch_size: int = INGEST_BATCH_SIZE,
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap: int = CHUNK_OVERLAP_TOKENS,
+    tokenizer=None
+) -> Dict[str, int]:
+    """
+    Stream documents through chunking, dedup and batched embedding into the knowledge base.
+
+    Sources are read and chunked one document at a time and only one batch of chunks
+    waits for embedding, so ingestion itself needs memory for the largest single
+    document plus a batch; the knowledge base still holds every chunk in memory.
+    Re-ingesting a changed document replaces its changed chunks and removes the ones
+    it no longer produces; unchanged chunks and content already present are skipped.
+    """
+    stats = {"chunks": 0, "duplicates": 0, "unchanged": 0, "added": 0, "removed": 0}
+    tokenizer = tokenizer or _default_tokenizer()
+
+    pending = []
+    pending_hashes = set()
+    for document in documents:
+        chunk_ids = set()
+        for chunk in chunk_document(document, max_tokens=max_tokens, overlap=overlap, tokenizer=tokenizer):
+            stats["chunks"] += 1
+            chunk_ids.add(chunk.id)
+            chunk_hash = content_hash(chunk.content)
+
+            existing = knowledge_base.documents.get(chunk.id)
+            if existing is not None:
+                # Same id: keep it if unchanged, otherwise add_documents replaces it
+                if content_hash(existing.content) == chunk_hash:
+                    stats["unchanged"] += 1
+                    continue
+            elif not chunk.content.strip() or chunk_hash in knowledge_base.content_hashes or chunk_hash in pending_hashes:
+                # Skip content already embedded under another id, on a previous run or earlier in this batch
+                stats["duplicates"] += 1
+                continue
+
+            pending.append(chunk)
+            pending_hashes.add(chunk_hash)
+            if len(pending) >= batch_size:
+                knowledge_base.add_documents(pending)
+                stats["added"] += len(pending)
+                pending, pending_hashes = [], set()
+
+        # Chunks left over from an earlier, longer version of this document
+        stale = knowledge_base.source_document_ids(document.id) - chunk_ids
+        if stale:
+            knowledge_base.remove_documents(stale)
+            stats["removed"] += len(stale)
+
+    if pending:
+        knowledge_base.add_documents(pending)
+        stats["added"] += len(pending)
+
+    logger.info(
+        f"Ingestion finished - Chunks: {stats['chunks']}, Added: {stats['added']}, "
+        f"Unchanged: {stats['unchanged']}, Duplicates: {stats['duplicates']}, Removed: {stats['removed']}"
+    )
+    return stats
+
+if __name__ == "__main__":
+    # Usage: python -m app.ingestion <file|directory|file.ndjson> <knowledge_base_path>
+    source_path, kb_path = sys.argv[1], sys.argv[2]
+    kb = KnowledgeBase.load(kb_path) if os.path.exists(f"{kb_path}.index") else KnowledgeBase()
+    ingest(iter_source(source_path), kb)
+    kb.save(kb_path)
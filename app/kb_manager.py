@@ -0,0 +1,273 @@
+import os
+import re
+import sys
+import glob
+import time
+import heapq
+import asyncio
+import logging
+import multiprocessing
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from app.advanced_llm import Document, KnowledgeBase
+from app.embeddings import get_embedding_model
+from app.retrieval import ResidentKnowledgeBase, get_resident_knowledge_base
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Directory holding one knowledge base per collection:
+#   <dir>/<collection>.index + .json               single index
+#   <dir>/<collection>.shard<N>.index + .json      sharded across worker processes
+KNOWLEDGE_BASE_DIR = os.getenv("KNOWLEDGE_BASE_DIR")
+KNOWLEDGE_BASE_MEMORY_BUDGET_MB = int(os.getenv("KNOWLEDGE_BASE_MEMORY_BUDGET_MB", "2048"))
+DEFAULT_COLLECTION = os.getenv("KNOWLEDGE_BASE_DEFAULT_COLLECTION", "default")
+# How long a collection found missing on disk is remembered before checking again
+KNOWLEDGE_BASE_MISSING_TTL = float(os.getenv("KNOWLEDGE_BASE_MISSING_TTL", "30"))
+
+_COLLECTION_PATTERN = re.compile(r"^[A-Za-z0-9_\-]+$")
+
+# Shard worker state: each worker process holds exactly one shard
+_shard_kb: Optional[KnowledgeBase] = None
+
+def _load_shard(path: str):
+    """Process initializer that loads the shard this worker serves"""
+    global _shard_kb
+    _shard_kb = KnowledgeBase.load(path)
+
+def _search_shard(queries, k, filters, mode, query_embeddings):
+    """Search this worker's shard with embeddings computed by the parent"""
+    return _shard_kb.search_batch_scored(queries, k, filters, mode, query_embeddings)
+
+class ShardedKnowledgeBase:
+    """
+    One collection split across several local worker processes.
+
+    The query is embedded once in the parent, scattered to every shard, and
+    the per-shard top-k lists are merged by score. Shard workers never load
+    the embedding model. Hybrid scores are fused per shard, so the merge is
+    an approximation of a global fusion.
+    """
+    def __init__(self, shard_paths: List[str]):
+        self.shard_paths = shard_paths
+        # Spawn rather than fork so workers don't inherit torch or the event loop
+        context = multiprocessing.get_context("spawn")
+        self.shards = [
+            ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_load_shard, initargs=(path,))
+            for path in shard_paths
+        ]
+
+    def memory_bytes(self) -> int:
+        """Shard size on disk, as a stand-in for what the workers hold"""
+        return sum(
+            os.path.getsize(f"{path}{suffix}")
+            for path in self.shard_paths
+            for suffix in (".index", ".json")
+        )
+
+    async def search(
+        self,
+        query: str,
+        k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+        mode: str = "vector"
+    ) -> List[Document]:
+        """Scatter the query to every shard and gather the global top-k"""
+        loop = asyncio.get_running_loop()
+
+        query_embeddings = None
+        if mode in ("vector", "hybrid"):
+            embedding_model = get_embedding_model()
+            if not embedding_model:
+                raise ValueError("Embedding model not loaded")
+            query_embeddings = await loop.run_in_executor(None, embedding_model.encode, [query])
+
+        shard_results = await asyncio.gather(*(
+            loop.run_in_executor(shard, _search_shard, [query], k, [filters], mode, query_embeddings)
+            for shard in self.shards
+        ))
+
+        hits = (hit for results in shard_results for hit in results[0])
+        return [doc for _, doc in heapq.nlargest(k, hits, key=lambda hit: hit[0])]
+
+    async def close(self):
+        """Stop the shard worker processes"""
+        for shard in self.shards:
+            shard.shutdown(wait=False, cancel_futures=True)
+
+class KnowledgeBaseManager:
+    """
+    Per-collection (per-tenant) knowledge bases, loaded on demand and evicted
+    least-recently-used first once their estimated size exceeds the memory budget.
+    Searches hold a reference, and an evicted collection is only closed once
+    the searches still running against it have finished.
+    """
+    def __init__(self, base_dir: str, memory_budget_mb: int = KNOWLEDGE_BASE_MEMORY_BUDGET_MB):
+        self.base_dir = base_dir
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._collections: "OrderedDict[str, Any]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._refs: Dict[Any, int] = defaultdict(int)
+        self._retired = set()  # evicted while in use; closed on last release()
+        self._missing: Dict[str, float] = {}  # collection -> when it was found missing
+
+    def _path(self, collection: str) -> str:
+        if not _COLLECTION_PATTERN.match(collection):
+            raise ValueError(f"Invalid collection name: {collection}")
+        return os.path.join(self.base_dir, collection)
+
+    def _shard_paths(self, collection: str) -> List[str]:
+        path = self._path(collection)
+        return sorted(
+            (index_file[:-len(".index")] for index_file in glob.glob(f"{path}.shard*.index")),
+            key=lambda shard: int(shard.rsplit(".shard", 1)[1])
+        )
+
+    def exists(self, collection: str) -> bool:
+        """Check whether a collection is loaded or has an index on disk"""
+        if collection in self._collections or collection in self._loading:
+            return True
+        missing_at = self._missing.get(collection)
+        if missing_at is not None and time.monotonic() - missing_at < KNOWLEDGE_BASE_MISSING_TTL:
+            return False
+
+        path = self._path(collection)
+        found = os.path.exists(f"{path}.index") or bool(self._shard_paths(collection))
+        if found:
+            self._missing.pop(collection, None)
+        else:
+            if len(self._missing) >= 10000:
+                self._missing.clear()  # bound the cache; entries are cheap to rebuild
+            self._missing[collection] = time.monotonic()
+        return found
+
+    def _open(self, collection: str):
+        """Load a collection (runs on a worker thread)"""
+        shard_paths = self._shard_paths(collection)
+        if shard_paths:
+            return ShardedKnowledgeBase(shard_paths)
+        knowledge_base = ResidentKnowledgeBase(self._path(collection))
+        knowledge_base.reload()
+        return knowledge_base
+
+    async def acquire(self, collection: str):
+        """
+        Return a loaded collection, loading it and evicting others if needed.
+        The caller holds a reference until it calls release().
+        """
+        while True:
+            knowledge_base = self._collections.get(collection)
+            if knowledge_base is not None:
+                self._collections.move_to_end(collection)
+                self._refs[knowledge_base] += 1
+                return knowledge_base
+
+            # Concurrent requests for the same collection share one load, then
+            # re-check since it may have been evicted again in the meantime
+            if collection in self._loading:
+                await asyncio.shield(self._loading[collection])
+                continue
+
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._loading[collection] = future
+            try:
+                knowledge_base = await loop.run_in_executor(None, self._open, collection)
+                self._collections[collection] = knowledge_base
+                self._refs[knowledge_base] += 1
+                future.set_result(knowledge_base)
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            finally:
+                del self._loading[collection]
+
+            await self._evict()
+            return knowledge_base
+
+    async def release(self, knowledge_base):
+        """Drop a reference taken by acquire(), closing the collection if it was evicted meanwhile"""
+        self._refs[knowledge_base] -= 1
+        if self._refs[knowledge_base] <= 0:
+            del self._refs[knowledge_base]
+            if knowledge_base in self._retired:
+                self._retired.discard(knowledge_base)
+                await knowledge_base.close()
+
+    async def _evict(self):
+        """Drop least-recently-used collections until the rest fit the budget"""
+        total = sum(kb.memory_bytes() for kb in self._collections.values())
+        while total > self.memory_budget and len(self._collections) > 1:
+            collection, knowledge_base = self._collections.popitem(last=False)
+            total -= knowledge_base.memory_bytes()
+            if self._refs.get(knowledge_base):
+                self._retired.add(knowledge_base)
+            else:
+                await knowledge_base.close()
+            logger.info(f"Evicted knowledge base collection {collection}")
+
+    async def search(
+        self,
+        collection: Optional[str],
+        query: str,
+        k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+        mode: str = "vector"
+    ) -> Optional[List[Document]]:
+        """Search a collection, falling back to the default one; None if neither exists"""
+        if not collection or not self.exists(collection):
+            collection = DEFAULT_COLLECTION
+            if not self.exists(collection):
+                return None
+        knowledge_base = await self.acquire(collection)
+        try:
+            return await knowledge_base.search(query, k=k, filters=filters, mode=mode)
+        finally:
+            await self.release(knowledge_base)
+
+_manager: Optional[KnowledgeBaseManager] = None
+
+def get_knowledge_base_manager() -> Optional[KnowledgeBaseManager]:
+    """Return this process's manager, or None if KNOWLEDGE_BASE_DIR is not set"""
+    global _manager
+    if _manager is None and KNOWLEDGE_BASE_DIR:
+        _manager = KnowledgeBaseManager(KNOWLEDGE_BASE_DIR)
+    return _manager
+
+def knowledge_base_configured() -> bool:
+    """Whether RAG has any knowledge base to search"""
+    return bool(KNOWLEDGE_BASE_DIR) or get_resident_knowledge_base() is not None
+
+async def search_knowledge_base(
+    collection: Optional[str],
+    query: str,
+    k: int = 5,
+    filters: Optional[Dict[str, Any]] = None,
+    mode: str = "vector"
+) -> Optional[List[Document]]:
+    """Search the collection's knowledge base, or the single resident one if no directory is configured"""
+    manager = get_knowledge_base_manager()
+    if manager is not None:
+        return await manager.search(collection, query, k=k, filters=filters, mode=mode)
+    knowledge_base = get_resident_knowledge_base()
+    if knowledge_base is not None:
+        return await knowledge_base.search(query, k=k, filters=filters, mode=mode)
+    return None
+
+def shard_knowledge_base(source_path: str, num_shards: int):
+    """Split a saved knowledge base into round-robin shards next to it"""
+    source = KnowledgeBase.load(source_path)
+    source.compact()
+    shards = [KnowledgeBase(dimension=source.dimension) for _ in range(num_shards)]
+    for row, doc_id in enumerate(source.document_ids):
+        shards[row % num_shards].add_document(source.documents[doc_id])
+    for i, shard in enumerate(shards):
+        shard.save(f"{source_path}.shard{i}")
+    logger.info(f"Split {source_path} into {num_shards} shards")
+
+if __name__ == "__main__":
+    # Usage: python -m app.kb_manager <knowledge_base_path> <num_shards>
+    shard_knowledge_base(sys.argv[1], int(sys.argv[2]))
@@ -7,6 +7,11 @@ import redis
 import json
 import logging
 from tenacity import retry, stop_after_attempt, wait_exponential
+
+from app.advanced_llm import RAGProcessor
+from app.monitoring import trace_stage, record_token_usage
+from app.kb_manager import knowledge_base_configured, search_knowledge_base
+from app.usage import record_user_usage
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,8 +31,19 @@ MODEL_TOKEN_LIMITS = {
     "claude-2": 100000
 }
 
+# Tokens reserved for the model's response
+RESPONSE_TOKENS = 1000
+
+# RAG settings
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1500"))
+RAG_SEARCH_MODE = os.getenv("RAG_SEARCH_MODE", "hybrid")
+
 def get_llm_client(model_name: str):
     """Return appropriate client based on model name"""
+    if model_name not in MODEL_TOKEN_LIMITS:
+        # Unknown names get the default model, so metric labels stay bounded
+        model_name = "gpt-3.5-turbo"
     if model_name.startswith("gpt"):
         return OpenAIClient(api_key=OPENAI_API_KEY, model_name=model_name)
     elif model_name.startswith("claude"):
@@ -41,6 +57,8 @@ class BaseLLMClient:
     def __init__(self, api_key: str, model_name: str):
         self.api_key = api_key
         self.model_name = model_name
+        # (prompt_tokens, completion_tokens) reported by the provider for the last call
+        self.last_usage = None
     
     async def generate_response(self, messages: List[Dict[str, str]]) -> str:
         """Generate a response from the LLM"""
@@ -77,6 +95,9 @@ class OpenAIClient(BaseLLMClient):
                 frequency_penalty=0.0,
                 presence_penalty=0.0
             )
+            usage = getattr(response, "usage", None)
+            if usage:
+                self.last_usage = (usage.prompt_tokens, usage.completion_tokens)
             return response.choices[0].message.content
         except Exception as e:
             logger.error(f"Error generating response from OpenAI: {str(e)}")
@@ -123,12 +144,18 @@ class AnthropicClient(BaseLLMClient):
 async def process_message(
     llm_client: BaseLLMClient,
     message_history: List[Dict[str, str]],
-    current_message: str
+    current_message: str,
+    use_rag: Optional[bool] = None,
+    collection: Optional[str] = None,
+    user_id: Optional[str] = None
 ) -> str:
     """Process a message through the LLM and return the response"""
-    # Check cache first
-    cache_key = f"response:{hash(json.dumps(message_history))}{hash(current_message)}"
-    cached_response = redis_client.get(cache_key)
+    model = llm_client.model_name
+    
+    # Check cache first; keyed by collection so tenants never share responses
+    cache_key = f"response:{collection or ''}:{hash(json.dumps(message_history))}{hash(current_message)}"
+    with trace_stage("cache_lookup", model):
+        cached_response = redis_client.get(cache_key)
     
     if cached_response:
         return cached_response.decode('utf-8')
@@ -146,24 +173,73 @@ async def process_message(
     # Add current message
     messages.append({"role": "user", "content": current_message})
     
-    # Ensure we don't exceed token limit by truncating history if needed
-    truncated_messages = truncate_messages(llm_client, messages)
+    # Retrieve context from the knowledge base (RAG is on whenever one is configured)
+    context_message = None
+    if knowledge_base_configured() and use_rag is not False:
+        context_message = await build_context_message(llm_client, current_message, collection)
+    
+    # Ensure we don't exceed token limit by truncating history if needed,
+    # leaving room for the retrieved context
+    with trace_stage("truncate", model):
+        reserved_tokens = llm_client.count_tokens(context_message["content"]) if context_message else 0
+        truncated_messages = truncate_messages(llm_client, messages, reserved_tokens=reserved_tokens)
+        if context_message:
+            truncated_messages.insert(1, context_message)
     
     # Generate response
-    response = await llm_client.generate_response(truncated_messages)
+    with trace_stage("provider", model):
+        response = await llm_client.generate_response(truncated_messages)
+    
+    # Feed provider-reported usage into the token counters
+    if llm_client.last_usage:
+        record_token_usage(model, *llm_client.last_usage)
+        if user_id:
+            record_user_usage(redis_client, user_id, model, *llm_client.last_usage)
     
-    # Cache the response (expire after 1 hour)
-    redis_client.setex(cache_key, 3600, response)
+    # Cache the response (expire after 1 hour), unless it was built from retrieved
+    # context, which goes stale as soon as the knowledge base is reloaded
+    if context_message is None:
+        with trace_stage("cache_store", model):
+            redis_client.setex(cache_key, 3600, response)
     
     return response
 
-def truncate_messages(llm_client: BaseLLMClient, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
-    """Truncate message history to fit within token limit"""
+async def build_context_message(
+    llm_client: BaseLLMClient,
+    query: str,
+    collection: Optional[str] = None
+) -> Optional[Dict[str, str]]:
+    """Retrieve documents for the query and pack them into a system message within the RAG token budget"""
+    try:
+        with trace_stage("retrieve", llm_client.model_name):
+            documents = await search_knowledge_base(collection, query, k=RAG_TOP_K, mode=RAG_SEARCH_MODE)
+    except Exception as e:
+        logger.error(f"Error retrieving RAG context: {str(e)}")
+        return None
+    
+    if not documents:
+        return None
+    
+    # Never let retrieved context take more than half of the prompt window
+    token_limit = MODEL_TOKEN_LIMITS.get(llm_client.model_name, 4096)
+    token_budget = min(RAG_CONTEXT_TOKENS, (token_limit - RESPONSE_TOKENS) // 2)
+    
+    with trace_stage("pack_context", llm_client.model_name):
+        prompt = RAGProcessor.build_prompt(query, documents, llm_client.count_tokens, token_budget)
+    
+    return {"role": "system", "content": prompt}
+
+def truncate_messages(
+    llm_client: BaseLLMClient,
+    messages: List[Dict[str, str]],
+    reserved_tokens: int = 0
+) -> List[Dict[str, str]]:
+    """Truncate message history to fit within token limit, less any tokens reserved for other context"""
     # Get token limit for the model
     token_limit = MODEL_TOKEN_LIMITS.get(llm_client.model_name, 4096)
     
-    # Reserve tokens for the response (1000) and system message
-    available_tokens = token_limit - 1000
+    # Reserve tokens for the response, extra context and system message
+    available_tokens = token_limit - RESPONSE_TOKENS - reserved_tokens
     
     # Always keep system message
     system_message = messages[0] if messages and messages[0]["role"] == "system" else None
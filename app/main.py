@@ -1,10 +1,13 @@
 
 import os
-from fastapi import FastAPI, Depends, HTTPException, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, BackgroundTasks, Header, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
+from sqlalchemy import and_, or_
 import asyncio
+import base64
 import time
 import uuid
 from datetime import datetime
@@ -13,8 +16,28 @@ import logging
 # Import our custom modules
 from app.database import get_db, SessionLocal, engine, Base
 from app.models import Conversation, Message
-from app.llm_service import process_message, get_llm_client
+from app.llm_service import process_message, get_llm_client, redis_client, MODEL_TOKEN_LIMITS
 from app.auth import get_current_user, User
+from app.embeddings import preload_for_fork, warm_up
+from app.retrieval import get_resident_knowledge_base
+from app.compression import CompressionMiddleware
+from app.notifications import publish_reply, reply_failed, reply_notifier, REPLY_READY, REPLY_FAILED
+from app.search import search_messages
+from app.archive import iter_export
+from app.usage import check_quota, flush_usage, run_usage_flusher
+from app.monitoring import (
+    APP_NAME,
+    PrometheusMiddleware,
+    metrics_app,
+    start_metrics_server,
+    trace_stage,
+    record_active_user,
+    run_active_users_refresher,
+    TIME_TO_FIRST_TOKEN,
+    TIME_TO_COMPLETION,
+    BACKGROUND_QUEUE_DEPTH,
+    BACKGROUND_QUEUE_AGE,
+)
 
 # Create database tables
 Base.metadata.create_all(bind=engine)
@@ -22,6 +45,26 @@ Base.metadata.create_all(bind=engine)
 # Initialize FastAPI app
 app = FastAPI(title="Scalable LLM Chatbot API")
 
+# Load the embedding model in the parent before workers fork (gunicorn --preload)
+if os.getenv("EMBEDDING_PRELOAD") == "1":
+    preload_for_fork()
+
+@app.on_event("startup")
+async def warm_up_embedding_model():
+    """Optionally load the embedding model at startup instead of on the first RAG query"""
+    if os.getenv("EMBEDDING_WARMUP") == "1":
+        await asyncio.get_running_loop().run_in_executor(None, warm_up)
+
+@app.on_event("startup")
+async def load_knowledge_base():
+    """Load the resident knowledge base once per process, off the event loop"""
+    knowledge_base = get_resident_knowledge_base()
+    if knowledge_base is not None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, knowledge_base.reload)
+        except Exception as e:
+            logger.error(f"Error loading knowledge base: {str(e)}")
+
 @app.get("/health")
 def health_check():
     if check_db_connection():
@@ -29,6 +72,21 @@ def health_check():
     else:
         return {"status": "Database connection failed"}
 
+@app.on_event("startup")
+async def start_active_users_refresher():
+    """Keep the active users gauge current even when this worker sees no traffic"""
+    app.state.active_users_refresher = asyncio.get_running_loop().create_task(run_active_users_refresher(redis_client))
+
+@app.on_event("startup")
+async def start_usage_flusher():
+    """Periodically move per-user token counters from Redis into the usage ledger"""
+    app.state.usage_flusher = asyncio.get_running_loop().create_task(run_usage_flusher(redis_client))
+
+@app.on_event("shutdown")
+async def stop_usage_flusher():
+    app.state.usage_flusher.cancel()
+    await asyncio.get_running_loop().run_in_executor(None, flush_usage, redis_client)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -38,6 +96,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large responses (brotli or gzip) for clients that accept it
+app.add_middleware(CompressionMiddleware, minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", "1024")))
+
+# Record request metrics by route template; added last so it wraps every other middleware
+app.add_middleware(PrometheusMiddleware, routes=app.routes)
+
+# Expose metrics on a side port if METRICS_PORT is set, otherwise on the main app.
+# With several workers (PROMETHEUS_MULTIPROC_DIR set) only one process may bind
+# the side port, so it is served by a separate `python -m app.monitoring`.
+METRICS_PORT = os.getenv("METRICS_PORT")
+if METRICS_PORT:
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        @app.on_event("startup")
+        async def start_metrics():
+            start_metrics_server(int(METRICS_PORT))
+else:
+    app.mount("/metrics", metrics_app())
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -59,16 +135,88 @@ class ConversationResponse(BaseModel):
     id: str
     title: str
     created_at: datetime
+    messages: Optional[List[MessageResponse]] = None  # omitted with include_messages=false
+
+class MessageDeltaResponse(BaseModel):
     messages: List[MessageResponse]
+    cursor: Optional[str]  # pass as ?after= to get only messages newer than these
+    has_more: bool
+
+class SearchResult(BaseModel):
+    message_id: str
+    conversation_id: str
+    conversation_title: str
+    role: str
+    created_at: datetime
+    rank: float
+    snippet: str  # HTML-escaped text with matched terms wrapped in <b></b>
+
+class SearchResponse(BaseModel):
+    results: List[SearchResult]
+    has_more: bool
+
+# Opaque cursors over the (created_at, id) order of messages
+def encode_cursor(message) -> str:
+    raw = f"{message.created_at.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, message_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), message_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def previous_cursor(db, message) -> Optional[str]:
+    """Cursor of the message just before this one in its conversation, if there is one"""
+    previous = db.query(Message.id, Message.created_at).filter(
+        Message.conversation_id == message.conversation_id,
+        or_(
+            Message.created_at < message.created_at,
+            and_(Message.created_at == message.created_at, Message.id < message.id)
+        )
+    ).order_by(Message.created_at.desc(), Message.id.desc()).first()
+    return encode_cursor(previous) if previous else None
+
+def cursor_headers(db, message) -> dict:
+    """
+    X-Cursor for a message the client now holds, plus X-Previous-Cursor for the
+    message before it. Clients should only jump their sync cursor to X-Cursor
+    when theirs equals X-Previous-Cursor; otherwise they have missed messages
+    (another tab, a reply that arrived late) and should fetch the delta instead.
+    """
+    headers = {"X-Cursor": encode_cursor(message)}
+    previous = previous_cursor(db, message)
+    if previous:
+        headers["X-Previous-Cursor"] = previous
+    return headers
 
 # Routes
-@app.post("/api/messages/", response_model=MessageResponse)
+@app.post("/api/messages/", response_model=MessageResponse, response_class=ORJSONResponse)
 async def create_message(
     message_request: MessageRequest, 
     background_tasks: BackgroundTasks,
+    response: Response,
     current_user: User = Depends(get_current_user),
     db: SessionLocal = Depends(get_db)
 ):
+    # model_name becomes a metric label, so only known models are accepted
+    if message_request.model_name not in MODEL_TOKEN_LIMITS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Unknown model; choose one of: {', '.join(MODEL_TOKEN_LIMITS)}"
+        )
+    
+    # Quota reads only the Redis counter, so enforcing it adds no database work
+    allowed, reset_in = check_quota(redis_client, current_user.id)
+    if not allowed:
+        raise HTTPException(
+            status_code=429,
+            detail="Daily token quota exceeded",
+            headers={"Retry-After": str(reset_in)}
+        )
+    
     try:
         # Generate conversation_id if not provided
         conversation_id = message_request.conversation_id
@@ -82,6 +230,16 @@ async def create_message(
             )
             db.add(new_conversation)
             db.commit()
+        else:
+            # Keep the conversation hot; archiving moves out ones idle past the retention window.
+            # No row matched means it isn't this user's, or it has been archived
+            updated = db.query(Conversation).filter(
+                Conversation.id == conversation_id,
+                Conversation.user_id == current_user.id
+            ).update({Conversation.updated_at: datetime.utcnow()}, synchronize_session=False)
+            if not updated:
+                db.rollback()
+                raise HTTPException(status_code=404, detail="Conversation not found")
         
         # Save user message
         user_message = Message(
@@ -93,14 +251,21 @@ async def create_message(
         )
         db.add(user_message)
         db.commit()
+        saved_at = time.monotonic()
+        response.headers.update(cursor_headers(db, user_message))
+        
+        record_active_user(redis_client, current_user.id)
         
         # Process message in background to avoid blocking
+        BACKGROUND_QUEUE_DEPTH.labels(app_name=APP_NAME).inc()
         background_tasks.add_task(
             process_message_task,
             message_request.content,
             conversation_id,
             current_user.id,
-            message_request.model_name
+            message_request.model_name,
+            saved_at,
+            user_message.id
         )
         
         return MessageResponse(
@@ -111,75 +276,267 @@ async def create_message(
             conversation_id=conversation_id
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error creating message: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to process message: {str(e)}")
 
-async def process_message_task(content: str, conversation_id: str, user_id: str, model_name: str):
+async def process_message_task(
+    content: str,
+    conversation_id: str,
+    user_id: str,
+    model_name: str,
+    saved_at: Optional[float] = None,
+    user_message_id: Optional[str] = None
+):
     """Background task to process messages through LLM"""
+    # saved_at is time.monotonic() when the user message was committed
+    saved_at = saved_at or time.monotonic()
+    BACKGROUND_QUEUE_DEPTH.labels(app_name=APP_NAME).dec()
+    BACKGROUND_QUEUE_AGE.labels(app_name=APP_NAME).observe(time.monotonic() - saved_at)
+    
     db = SessionLocal()
     try:
-        # Get conversation history
-        messages = db.query(Message).filter(
-            Message.conversation_id == conversation_id
-        ).order_by(Message.created_at).all()
-        
-        # Convert to format expected by LLM service
-        message_history = [{"role": msg.role, "content": msg.content} for msg in messages]
-        
-        # Get response from LLM
         llm_client = get_llm_client(model_name)
-        response_content = await process_message(llm_client, message_history, content)
+        model = llm_client.model_name  # normalized, so labels stay bounded
+        with trace_stage("process_message", model, conversation_id=conversation_id):
+            # Get conversation history
+            with trace_stage("load_history", model):
+                messages = db.query(Message).filter(
+                    Message.conversation_id == conversation_id
+                ).order_by(Message.created_at).all()
+                
+                # Convert to format expected by LLM service
+                message_history = [{"role": msg.role, "content": msg.content} for msg in messages]
+            
+            # Get response from LLM
+            response_content = await process_message(
+                llm_client, message_history, content, collection=user_id, user_id=user_id
+            )
+            # Responses are not streamed, so the first token arrives with the full reply
+            TIME_TO_FIRST_TOKEN.labels(app_name=APP_NAME, model=model).observe(time.monotonic() - saved_at)
+            
+            # Save assistant response
+            with trace_stage("persist", model):
+                assistant_message = Message(
+                    id=str(uuid.uuid4()),
+                    content=response_content,
+                    role="assistant",
+                    conversation_id=conversation_id,
+                    user_id=user_id,
+                    reply_to_id=user_message_id
+                )
+                db.add(assistant_message)
+                db.commit()
+            TIME_TO_COMPLETION.labels(app_name=APP_NAME, model=model).observe(time.monotonic() - saved_at)
         
-        # Save assistant response
-        assistant_message = Message(
-            id=str(uuid.uuid4()),
-            content=response_content,
-            role="assistant",
-            conversation_id=conversation_id,
-            user_id=user_id
-        )
-        db.add(assistant_message)
-        db.commit()
+        # Wake any client long-polling for this reply
+        if user_message_id:
+            publish_reply(redis_client, user_message_id)
         
     except Exception as e:
         logger.error(f"Error in background task: {str(e)}")
+        if user_message_id:
+            publish_reply(redis_client, user_message_id, REPLY_FAILED)
     finally:
         db.close()
 
-@app.get("/api/conversations/", response_model=List[ConversationResponse])
+@app.get("/api/conversations/", response_model=List[ConversationResponse], response_class=ORJSONResponse)
 async def get_conversations(
+    include_messages: bool = Query(True, description="Set false to list conversations without their messages"),
     current_user: User = Depends(get_current_user),
     db: SessionLocal = Depends(get_db)
 ):
-    conversations = db.query(Conversation).filter(
+    # Read plain column tuples and build the payload directly; returning the
+    # response ourselves skips per-message model validation on this read path
+    conversations = db.query(
+        Conversation.id, Conversation.title, Conversation.created_at
+    ).filter(
         Conversation.user_id == current_user.id
     ).order_by(Conversation.created_at.desc()).all()
     
+    if not include_messages:
+        return ORJSONResponse([
+            {"id": conv_id, "title": title, "created_at": created_at}
+            for conv_id, title, created_at in conversations
+        ])
+    
     result = []
-    for conv in conversations:
-        messages = db.query(Message).filter(
-            Message.conversation_id == conv.id
-        ).order_by(Message.created_at).all()
+    messages_by_conversation = {}
+    for conv_id, title, created_at in conversations:
+        messages_by_conversation[conv_id] = []
+        result.append({
+            "id": conv_id,
+            "title": title,
+            "created_at": created_at,
+            "messages": messages_by_conversation[conv_id]
+        })
+    
+    # One query for every message instead of one per conversation
+    messages = db.query(
+        Message.id, Message.content, Message.role, Message.created_at, Message.conversation_id
+    ).join(
+        Conversation, Message.conversation_id == Conversation.id
+    ).filter(
+        Conversation.user_id == current_user.id
+    ).order_by(Message.conversation_id, Message.created_at).all()
+    
+    for msg_id, content, role, created_at, conversation_id in messages:
+        conversation_messages = messages_by_conversation.get(conversation_id)
+        if conversation_messages is None:
+            continue  # conversation created after the list was read
+        conversation_messages.append({
+            "id": msg_id,
+            "content": content,
+            "role": role,
+            "created_at": created_at,
+            "conversation_id": conversation_id
+        })
+    
+    return ORJSONResponse(result)
+
+@app.get(
+    "/api/conversations/{conversation_id}/messages",
+    response_model=MessageDeltaResponse,
+    response_class=ORJSONResponse,
+    responses={304: {"description": "No messages after the cursor"}}
+)
+async def get_conversation_messages(
+    conversation_id: str,
+    after: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: SessionLocal = Depends(get_db)
+):
+    """Return only the messages after the given cursor, so clients sync in constant-size deltas"""
+    conversation = db.query(Conversation.id).filter(
+        Conversation.id == conversation_id,
+        Conversation.user_id == current_user.id
+    ).first()
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    
+    query = db.query(Message).filter(Message.conversation_id == conversation_id)
+    if after:
+        created_at, message_id = decode_cursor(after)
+        query = query.filter(or_(
+            Message.created_at > created_at,
+            and_(Message.created_at == created_at, Message.id > message_id)
+        ))
+    messages = query.order_by(Message.created_at, Message.id).limit(limit + 1).all()
+    
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    cursor = encode_cursor(messages[-1]) if messages else after
+    
+    # The ETag is the cursor itself: unchanged means nothing new since the client's last sync
+    etag = f'"{cursor or ""}"'
+    if not messages and if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    return ORJSONResponse({
+        "messages": [
+            {
+                "id": msg.id,
+                "content": msg.content,
+                "role": msg.role,
+                "created_at": msg.created_at,
+                "conversation_id": msg.conversation_id
+            } for msg in messages
+        ],
+        "cursor": cursor,
+        "has_more": has_more
+    }, headers={"ETag": etag})
+
+@app.get(
+    "/api/messages/{message_id}/reply",
+    response_model=MessageResponse,
+    response_class=ORJSONResponse,
+    responses={204: {"description": "No reply yet; poll again"}}
+)
+async def await_reply(
+    message_id: str,
+    timeout: float = Query(25, ge=0, le=60),
+    current_user: User = Depends(get_current_user),
+    db: SessionLocal = Depends(get_db)
+):
+    """Hold the request until the assistant reply to a user message is saved, or the timeout passes"""
+    user_message = db.query(Message.id).filter(
+        Message.id == message_id,
+        Message.user_id == current_user.id,
+        Message.role == "user"
+    ).first()
+    if user_message is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    
+    def find_reply():
+        return db.query(Message).filter(
+            Message.reply_to_id == message_id,
+            Message.role == "assistant"
+        ).first()
+    
+    reply = find_reply()
+    if reply is None and reply_failed(redis_client, message_id):
+        raise HTTPException(status_code=502, detail="Failed to generate a reply")
+    
+    if reply is None and timeout > 0:
+        # End the read transaction so no pooled connection is held while waiting
+        db.rollback()
         
-        message_responses = [
-            MessageResponse(
-                id=msg.id,
-                content=msg.content,
-                role=msg.role,
-                created_at=msg.created_at,
-                conversation_id=msg.conversation_id
-            ) for msg in messages
-        ]
+        async def reply_settled() -> Optional[str]:
+            found = find_reply() is not None
+            db.rollback()
+            if found:
+                return REPLY_READY
+            return REPLY_FAILED if reply_failed(redis_client, message_id) else None
         
-        result.append(ConversationResponse(
-            id=conv.id,
-            title=conv.title,
-            created_at=conv.created_at,
-            messages=message_responses
-        ))
+        status = await reply_notifier.wait(message_id, timeout, reply_settled)
+        if status == REPLY_FAILED:
+            raise HTTPException(status_code=502, detail="Failed to generate a reply")
+        if status is not None:
+            reply = find_reply()
+    
+    if reply is None:
+        return Response(status_code=204)
     
-    return result
+    return ORJSONResponse({
+        "id": reply.id,
+        "content": reply.content,
+        "role": reply.role,
+        "created_at": reply.created_at,
+        "conversation_id": reply.conversation_id
+    }, headers=cursor_headers(db, reply))
+
+@app.get("/api/search", response_model=SearchResponse, response_class=ORJSONResponse)
+async def search(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    current_user: User = Depends(get_current_user),
+    db: SessionLocal = Depends(get_db)
+):
+    """Full-text search over the current user's messages, best matches first"""
+    try:
+        results = search_messages(db, current_user.id, q, limit=limit + 1, offset=offset)
+    except Exception as e:
+        logger.error(f"Error searching messages: {str(e)}")
+        raise HTTPException(status_code=503, detail="Search is unavailable")
+    
+    return ORJSONResponse({
+        "results": results[:limit],
+        "has_more": len(results) > limit
+    })
+
+@app.get("/api/export")
+async def export_conversations(current_user: User = Depends(get_current_user)):
+    """Stream every conversation of the current user, archived and live, as NDJSON"""
+    return StreamingResponse(
+        iter_export(current_user.id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="conversations.ndjson"'}
+    )
 
 # Health check endpoint
 @app.get("/health")
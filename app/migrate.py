@@ -0,0 +1,88 @@
+import sys
+import logging
+
+from sqlalchemy import text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Indexes added to tables that already existed, as (name, "table (columns)")
+INDEXES = [
+    ("ix_messages_reply_to_id", "messages (reply_to_id)"),
+    ("ix_messages_conversation_created_id", "messages (conversation_id, created_at, id)"),
+    ("ix_conversations_updated_at", "conversations (updated_at)"),
+]
+
+def migrate(engine):
+    """
+    Bring an existing database up to the current models. create_all() only
+    creates missing tables, so columns and indexes added to existing tables
+    are applied here. Safe to re-run; run once per deploy with
+    ``python -m app.migrate`` before starting the new version.
+
+    PostgreSQL: the column is a catalog-only change and its foreign key is
+    added NOT VALID then validated, so neither holds an exclusive lock for a
+    table scan; indexes are built CONCURRENTLY. SQLite: plain ALTER TABLE and
+    CREATE INDEX IF NOT EXISTS.
+    """
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        _migrate_postgres(engine)
+    elif dialect == "sqlite":
+        _migrate_sqlite(engine)
+    else:
+        logger.info(f"No migrations for {dialect}; apply the schema changes by hand")
+
+def _migrate_postgres(engine):
+    with engine.begin() as conn:
+        conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+        conn.execute(text("ALTER TABLE messages ADD COLUMN IF NOT EXISTS reply_to_id VARCHAR"))
+        constraint = conn.execute(text(
+            "SELECT 1 FROM pg_constraint WHERE conname = 'messages_reply_to_id_fkey'"
+        )).first()
+        if not constraint:
+            conn.execute(text(
+                "ALTER TABLE messages ADD CONSTRAINT messages_reply_to_id_fkey "
+                "FOREIGN KEY (reply_to_id) REFERENCES messages (id) NOT VALID"
+            ))
+
+    # Validation scans the table under a lock that doesn't block reads or writes
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE messages VALIDATE CONSTRAINT messages_reply_to_id_fkey"))
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        for name, definition in INDEXES:
+            create_index_concurrently(conn, name, definition)
+
+def create_index_concurrently(conn, name: str, definition: str):
+    """CREATE INDEX CONCURRENTLY name ON definition, on an AUTOCOMMIT PostgreSQL connection"""
+    # An interrupted CONCURRENTLY build leaves an invalid index that IF NOT EXISTS would keep
+    invalid = conn.execute(text(
+        "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+        "WHERE c.relname = :name AND NOT i.indisvalid"
+    ), {"name": name}).first()
+    if invalid:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+    conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}"))
+    logger.info(f"Index {name} is in place")
+
+def _migrate_sqlite(engine):
+    with engine.begin() as conn:
+        columns = {row[1] for row in conn.execute(text("PRAGMA table_info(messages)"))}
+        if "reply_to_id" not in columns:
+            conn.execute(text("ALTER TABLE messages ADD COLUMN reply_to_id VARCHAR REFERENCES messages (id)"))
+        for name, definition in INDEXES:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}"))
+
+if __name__ == "__main__":
+    # Usage: python -m app.migrate
+    if sys.argv[1:]:
+        sys.exit("Usage: python -m app.migrate")
+    from app.database import engine, Base
+    from app import models  # noqa: F401 (registers the tables)
+    # New tables first, then changes to the ones that already existed
+    Base.metadata.create_all(bind=engine)
+    migrate(engine)
+    logger.info("Database schema is up to date")
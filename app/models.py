@@ -1,5 +1,5 @@
 
-from sqlalchemy import Column, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, String, Text, DateTime, Date, Integer, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import uuid
@@ -25,7 +25,7 @@ class Conversation(Base):
     title = Column(String)
     user_id = Column(String, ForeignKey("users.id"))
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)  # last activity; drives archiving
     
     user = relationship("User", back_populates="conversations")
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
@@ -38,7 +38,36 @@ class Message(Base):
     role = Column(String)  # 'user' or 'assistant'
     conversation_id = Column(String, ForeignKey("conversations.id"))
     user_id = Column(String, ForeignKey("users.id"))
+    reply_to_id = Column(String, ForeignKey("messages.id"), nullable=True, index=True)  # user message an assistant message answers
     created_at = Column(DateTime, default=datetime.utcnow)
     
     conversation = relationship("Conversation", back_populates="messages")
     user = relationship("User", back_populates="messages")
+    
+    # Serves history loads and cursor-based delta sync in (created_at, id) order
+    __table_args__ = (
+        Index("ix_messages_conversation_created_id", "conversation_id", "created_at", "id"),
+    )
+
+class TokenUsage(Base):
+    __tablename__ = "token_usage"
+    
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(String, ForeignKey("users.id"))
+    model = Column(String)
+    period = Column(Date)  # UTC day
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # One row per user, model and day; flushes add to it
+    __table_args__ = (
+        UniqueConstraint("user_id", "model", "period", name="uq_token_usage_user_model_period"),
+    )
+
+class UsageFlush(Base):
+    __tablename__ = "usage_flushes"
+    
+    # The Redis flushing key whose counters were written; committed with them so a flush applies once
+    id = Column(String, primary_key=True)
+    applied_at = Column(DateTime, default=datetime.utcnow, index=True)
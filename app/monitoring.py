@@ -1,10 +1,15 @@
 
 import logging
+import sys
 import time
+import asyncio
+import json
+import uuid
+import contextvars
 import prometheus_client
 from prometheus_client import Counter, Histogram, Gauge
 import os
-from functools import wraps
+from contextlib import contextmanager, nullcontext
 
 # Configure logging
 logging.basicConfig(
@@ -13,6 +18,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Read once; label values are fixed for the life of the process
+APP_NAME = os.getenv("APP_NAME", "chatbot-api")
+
 # Set up Prometheus metrics
 REQUEST_COUNT = Counter(
     'request_count', 'App Request Count',
@@ -21,7 +29,20 @@ REQUEST_COUNT = Counter(
 
 REQUEST_LATENCY = Histogram(
     'request_latency_seconds', 'Request latency',
-    ['app_name', 'endpoint', 'method']
+    ['app_name', 'endpoint', 'method', 'status'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+
+REQUESTS_IN_PROGRESS = Gauge(
+    'requests_in_progress', 'Requests currently being handled',
+    ['app_name', 'endpoint', 'method'],
+    multiprocess_mode='livesum'
+)
+
+RESPONSE_SIZE = Histogram(
+    'response_size_bytes', 'Response body size',
+    ['app_name', 'endpoint', 'method', 'status'],
+    buckets=(100, 1000, 10000, 100000, 1000000, 10000000)
 )
 
 TOKEN_COUNT = Counter(
@@ -31,7 +52,32 @@ TOKEN_COUNT = Counter(
 
 ACTIVE_USERS = Gauge(
     'active_users', 'Number of Active Users',
-    ['app_name']
+    ['app_name'],
+    multiprocess_mode='mostrecent'  # every worker refreshes the same shared estimate; newest wins
+)
+
+TIME_TO_FIRST_TOKEN = Histogram(
+    'time_to_first_token_seconds', 'Time from user message saved to first assistant token',
+    ['app_name', 'model'],
+    buckets=(0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0)
+)
+
+TIME_TO_COMPLETION = Histogram(
+    'time_to_completion_seconds', 'Time from user message saved to assistant message saved',
+    ['app_name', 'model'],
+    buckets=(0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0)
+)
+
+BACKGROUND_QUEUE_DEPTH = Gauge(
+    'background_queue_depth', 'Background jobs scheduled but not yet started',
+    ['app_name'],
+    multiprocess_mode='livesum'
+)
+
+BACKGROUND_QUEUE_AGE = Histogram(
+    'background_queue_age_seconds', 'How long background jobs wait before starting',
+    ['app_name'],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 )
 
 ERROR_COUNT = Counter(
@@ -39,78 +85,223 @@ ERROR_COUNT = Counter(
     ['app_name', 'error_type']
 )
 
+PIPELINE_STAGE_LATENCY = Histogram(
+    'pipeline_stage_latency_seconds', 'Latency of each message processing stage',
+    ['app_name', 'stage', 'model'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+
+RETRIEVAL_LATENCY = Histogram(
+    'retrieval_latency_seconds', 'Knowledge base retrieval latency',
+    ['app_name', 'phase'],  # phase can be 'queue', 'search' or 'total'
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+
+RETRIEVAL_BATCH_SIZE = Histogram(
+    'retrieval_batch_size', 'Number of queries per retrieval micro-batch',
+    ['app_name'],
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+
+RETRIEVAL_QUEUE_DEPTH = Gauge(
+    'retrieval_queue_depth', 'Retrieval queries waiting to be batched',
+    ['app_name']
+)
+
+RETRIEVAL_REJECTED = Counter(
+    'retrieval_rejected', 'Retrieval queries rejected because the queue was full',
+    ['app_name']
+)
+
+# Span export for pipeline stages: TRACE_EXPORTER=otlp sends OpenTelemetry spans to a
+# local collector (OTEL_EXPORTER_OTLP_ENDPOINT), TRACE_EXPORTER=file appends JSON lines to TRACE_FILE
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+
+_current_trace_id = contextvars.ContextVar("current_trace_id", default=None)
+_tracer = None
+_trace_logger = None
+
+def _setup_tracing():
+    """Configure the span exporter selected by TRACE_EXPORTER"""
+    global _tracer, _trace_logger
+    if TRACE_EXPORTER == "otlp":
+        try:
+            from opentelemetry import trace
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            logger.error("TRACE_EXPORTER=otlp needs opentelemetry-sdk and opentelemetry-exporter-otlp installed")
+            return
+        provider = TracerProvider(resource=Resource.create({"service.name": APP_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        trace.set_tracer_provider(provider)
+        _tracer = trace.get_tracer(__name__)
+    elif TRACE_EXPORTER == "file":
+        _trace_logger = logging.getLogger(f"{__name__}.traces")
+        _trace_logger.propagate = False
+        _trace_logger.setLevel(logging.INFO)
+        handler = logging.FileHandler(TRACE_FILE)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _trace_logger.addHandler(handler)
+
+_setup_tracing()
+
+# Context manager for timing pipeline stages
+@contextmanager
+def trace_stage(stage: str, model: str = "", **attributes):
+    """
+    Time the wrapped block as a pipeline stage: always observed in the
+    pipeline_stage_latency_seconds histogram, and exported as a span when
+    tracing is enabled. Nested stages share the trace id of the outermost one.
+    """
+    trace_id = _current_trace_id.get()
+    token = None
+    if trace_id is None:
+        trace_id = uuid.uuid4().hex
+        token = _current_trace_id.set(trace_id)
+
+    span = nullcontext()
+    if _tracer is not None:
+        span = _tracer.start_as_current_span(stage, attributes={"model": model, **attributes})
+
+    started_at = time.time()
+    start_time = time.perf_counter()
+    error = None
+    try:
+        with span:
+            yield
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start_time
+        PIPELINE_STAGE_LATENCY.labels(app_name=APP_NAME, stage=stage, model=model).observe(duration)
+        if _trace_logger is not None:
+            _trace_logger.info(json.dumps({
+                "trace_id": trace_id,
+                "stage": stage,
+                "model": model,
+                "start": started_at,
+                "duration": duration,
+                "error": error,
+                **attributes
+            }, default=str))
+        if token is not None:
+            _current_trace_id.reset(token)
+
 # Set up metrics endpoint for Prometheus to scrape
-def start_metrics_server(port=8000):
-    """Start Prometheus metrics server"""
+def _metrics_registry():
+    """Registry to expose: aggregated across workers when PROMETHEUS_MULTIPROC_DIR is set"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import CollectorRegistry, multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return prometheus_client.REGISTRY
+
+def start_metrics_server(port=9100):
+    """
+    Start Prometheus metrics server. Call it from one process only: in the
+    worker itself for a single-process app, or via ``python -m app.monitoring``
+    alongside multiple workers.
+    """
     from prometheus_client import start_http_server
-    start_http_server(port)
+    start_http_server(port, registry=_metrics_registry())
     logger.info(f"Metrics server started on port {port}")
 
-# Decorator for endpoint monitoring
-def monitor_endpoint(endpoint=None):
-    """Decorator to monitor FastAPI endpoints"""
-    def decorator(func):
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
-            method = "POST"  # Determine method dynamically in real implementation
-            endpoint_name = endpoint or func.__name__
-            app_name = os.getenv("APP_NAME", "chatbot-api")
-            
-            # Record request
-            start_time = time.time()
-            
-            try:
-                # Execute the endpoint function
-                result = await func(*args, **kwargs)
-                
-                # Record successful request
-                REQUEST_COUNT.labels(
-                    app_name=app_name,
-                    endpoint=endpoint_name,
-                    method=method,
-                    status="success"
-                ).inc()
-                
-                return result
-            except Exception as e:
-                # Record failed request
-                REQUEST_COUNT.labels(
-                    app_name=app_name,
-                    endpoint=endpoint_name,
-                    method=method,
-                    status="error"
-                ).inc()
-                
-                # Record error
-                ERROR_COUNT.labels(
-                    app_name=app_name,
-                    error_type=type(e).__name__
-                ).inc()
-                
-                # Re-raise the exception
-                raise
-            finally:
-                # Record request latency
-                latency = time.time() - start_time
-                REQUEST_LATENCY.labels(
-                    app_name=app_name,
-                    endpoint=endpoint_name,
-                    method=method
-                ).observe(latency)
-        
-        return wrapper
-    return decorator
+def metrics_app():
+    """ASGI app serving /metrics, aggregating across workers when PROMETHEUS_MULTIPROC_DIR is set"""
+    return prometheus_client.make_asgi_app(registry=_metrics_registry())
+
+# ASGI middleware for request metrics
+class PrometheusMiddleware:
+    """
+    Records latency, request count, in-flight requests and response size for
+    every HTTP request, labelled by route template rather than raw path so
+    IDs in URLs don't create new series. Label children are bound once per
+    (route, method, status) and reused.
+    """
+    def __init__(self, app, routes=None):
+        self.app = app
+        self.routes = routes or []
+        self._request_metrics = {}
+        self._in_progress = {}
+
+    def _route_template(self, scope) -> str:
+        """Find the template of the route that will handle this request"""
+        from starlette.routing import Match
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", scope["path"])
+        return "unmatched"
+
+    def _metrics_for(self, endpoint: str, method: str, status: str):
+        key = (endpoint, method, status)
+        metrics = self._request_metrics.get(key)
+        if metrics is None:
+            labels = dict(app_name=APP_NAME, endpoint=endpoint, method=method, status=status)
+            metrics = (
+                REQUEST_COUNT.labels(**labels),
+                REQUEST_LATENCY.labels(**labels),
+                RESPONSE_SIZE.labels(**labels)
+            )
+            self._request_metrics[key] = metrics
+        return metrics
+
+    def _in_progress_for(self, endpoint: str, method: str):
+        key = (endpoint, method)
+        gauge = self._in_progress.get(key)
+        if gauge is None:
+            gauge = REQUESTS_IN_PROGRESS.labels(app_name=APP_NAME, endpoint=endpoint, method=method)
+            self._in_progress[key] = gauge
+        return gauge
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        endpoint = self._route_template(scope)
+        in_progress = self._in_progress_for(endpoint, method)
+        status = 500
+        response_size = 0
+
+        async def send_wrapper(message):
+            nonlocal status, response_size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_size += len(message.get("body", b""))
+            await send(message)
+
+        in_progress.inc()
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            ERROR_COUNT.labels(app_name=APP_NAME, error_type=type(e).__name__).inc()
+            raise
+        finally:
+            latency = time.perf_counter() - start_time
+            in_progress.dec()
+            count, latency_histogram, size_histogram = self._metrics_for(endpoint, method, str(status))
+            count.inc()
+            latency_histogram.observe(latency)
+            size_histogram.observe(response_size)
 
 # Function to record token usage
 def record_token_usage(model: str, prompt_tokens: int, completion_tokens: int):
     """Record token usage for billing and monitoring"""
-    app_name = os.getenv("APP_NAME", "chatbot-api")
-    
     # Record prompt tokens
-    TOKEN_COUNT.labels(app_name=app_name, model=model, type="prompt").inc(prompt_tokens)
+    TOKEN_COUNT.labels(app_name=APP_NAME, model=model, type="prompt").inc(prompt_tokens)
     
     # Record completion tokens
-    TOKEN_COUNT.labels(app_name=app_name, model=model, type="completion").inc(completion_tokens)
+    TOKEN_COUNT.labels(app_name=APP_NAME, model=model, type="completion").inc(completion_tokens)
     
     # Log token usage
     logger.info(f"Token usage - Model: {model}, Prompt: {prompt_tokens}, Completion: {completion_tokens}")
@@ -118,5 +309,44 @@ def record_token_usage(model: str, prompt_tokens: int, completion_tokens: int):
 # Function to update active users
 def update_active_users(count: int):
     """Update the active users gauge"""
-    app_name = os.getenv("APP_NAME", "chatbot-api")
-    ACTIVE_USERS.labels(app_name=app_name).set(count)
+    ACTIVE_USERS.labels(app_name=APP_NAME).set(count)
+
+# Active users are counted with a HyperLogLog per minute in Redis, so the
+# estimate covers every worker and stays ~12KB per bucket regardless of users
+ACTIVE_USERS_WINDOW_MINUTES = int(os.getenv("ACTIVE_USERS_WINDOW_MINUTES", "5"))
+ACTIVE_USERS_REFRESH_SECONDS = float(os.getenv("ACTIVE_USERS_REFRESH_SECONDS", "15"))
+
+def record_active_user(redis_client, user_id: str):
+    """Mark a user active in the current minute"""
+    key = f"active_users:{int(time.time() // 60)}"
+    try:
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.pfadd(key, user_id)
+        pipeline.expire(key, (ACTIVE_USERS_WINDOW_MINUTES + 1) * 60)
+        pipeline.execute()
+    except Exception as e:
+        logger.error(f"Error recording active user: {str(e)}")
+
+def refresh_active_users(redis_client):
+    """Set the gauge to the distinct users seen across all workers in the window"""
+    minute = int(time.time() // 60)
+    keys = [f"active_users:{minute - i}" for i in range(ACTIVE_USERS_WINDOW_MINUTES)]
+    try:
+        # PFCOUNT over several keys counts the union, i.e. distinct users in the window
+        update_active_users(redis_client.pfcount(*keys))
+    except Exception as e:
+        logger.error(f"Error refreshing active users: {str(e)}")
+
+async def run_active_users_refresher(redis_client, interval: float = ACTIVE_USERS_REFRESH_SECONDS):
+    """Refresh the active users gauge on a timer, so idle workers don't report a stale count"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await loop.run_in_executor(None, refresh_active_users, redis_client)
+        await asyncio.sleep(interval)
+
+if __name__ == "__main__":
+    # Usage: PROMETHEUS_MULTIPROC_DIR=<dir> python -m app.monitoring [port]
+    # Serves the workers' aggregated metrics from a single dedicated process
+    start_metrics_server(int(sys.argv[1]) if len(sys.argv) > 1 else int(os.getenv("METRICS_PORT", "9100")))
+    while True:
+        time.sleep(3600)
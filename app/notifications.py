@@ -0,0 +1,118 @@
+import os
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+import redis.asyncio as aioredis
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+
+REPLY_CHANNEL_PREFIX = "reply:"
+REPLY_READY = "ready"
+REPLY_FAILED = "failed"
+
+# Failures aren't stored with the messages, so keep them long enough for
+# clients that start waiting after the notification was published
+REPLY_STATUS_PREFIX = "reply_status:"
+REPLY_STATUS_TTL = int(os.getenv("REPLY_STATUS_TTL", "300"))
+
+def publish_reply(redis_client, user_message_id: str, status: str = REPLY_READY):
+    """Tell waiting clients on any worker that the reply to a user message is settled"""
+    try:
+        if status == REPLY_FAILED:
+            redis_client.setex(f"{REPLY_STATUS_PREFIX}{user_message_id}", REPLY_STATUS_TTL, status)
+        redis_client.publish(f"{REPLY_CHANNEL_PREFIX}{user_message_id}", status)
+    except Exception as e:
+        logger.error(f"Error publishing reply notification: {str(e)}")
+
+def reply_failed(redis_client, user_message_id: str) -> bool:
+    """Whether generating the reply to a user message failed recently"""
+    try:
+        return redis_client.get(f"{REPLY_STATUS_PREFIX}{user_message_id}") is not None
+    except Exception as e:
+        logger.error(f"Error reading reply status: {str(e)}")
+        return False
+
+class ReplyNotifier:
+    """
+    Wakes long-polling requests when a reply is published.
+
+    Each process keeps a single pattern subscription to reply:* and hands
+    notifications to the in-process waiters, instead of opening a Redis
+    connection per waiting request.
+    """
+    def __init__(self, redis_url: str = REDIS_URL):
+        self.redis_url = redis_url
+        self._redis = None
+        self._waiters: Dict[str, Set[asyncio.Future]] = defaultdict(set)
+        self._listener: Optional[asyncio.Task] = None
+        self._subscribed: Optional[asyncio.Event] = None
+
+    async def _ensure_listening(self):
+        if self._listener is None or self._listener.done():
+            if self._redis is None:
+                self._redis = aioredis.from_url(self.redis_url)
+            self._subscribed = asyncio.Event()
+            self._listener = asyncio.get_running_loop().create_task(self._listen())
+        await self._subscribed.wait()
+
+    async def _listen(self):
+        pubsub = self._redis.pubsub()
+        try:
+            await pubsub.psubscribe(f"{REPLY_CHANNEL_PREFIX}*")
+            self._subscribed.set()
+            async for message in pubsub.listen():
+                if message["type"] != "pmessage":
+                    continue
+                message_id = message["channel"].decode()[len(REPLY_CHANNEL_PREFIX):]
+                status = message["data"].decode()
+                for future in self._waiters.pop(message_id, ()):
+                    if not future.done():
+                        future.set_result(status)
+        except Exception as e:
+            logger.error(f"Reply listener stopped: {str(e)}")
+            # Release waiters so they fall back to checking the database
+            for futures in self._waiters.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_result(None)
+            self._waiters.clear()
+        finally:
+            self._subscribed.set()
+            await pubsub.close()
+
+    async def wait(
+        self,
+        user_message_id: str,
+        timeout: float,
+        check: Callable[[], Awaitable[Optional[str]]]
+    ) -> Optional[str]:
+        """
+        Wait until the reply to a user message is published or the timeout passes.
+        check() is run after subscribing so a reply settled just before is not missed;
+        it returns REPLY_READY or REPLY_FAILED if the outcome is already known, else None.
+        Returns the settled status, or None on timeout.
+        """
+        await self._ensure_listening()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[user_message_id].add(future)
+        try:
+            status = await check()
+            if status is not None:
+                return status
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._waiters.get(user_message_id)
+            if waiters is not None:
+                waiters.discard(future)
+                if not waiters:
+                    del self._waiters[user_message_id]
+
+reply_notifier = ReplyNotifier()
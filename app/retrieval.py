@@ -0,0 +1,278 @@
+import os
+import asyncio
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from app.advanced_llm import Document, KnowledgeBase
+from app.monitoring import (
+    APP_NAME,
+    RETRIEVAL_LATENCY,
+    RETRIEVAL_BATCH_SIZE,
+    RETRIEVAL_QUEUE_DEPTH,
+    RETRIEVAL_REJECTED,
+)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Micro-batching settings
+RETRIEVAL_BATCH_WINDOW_MS = float(os.getenv("RETRIEVAL_BATCH_WINDOW_MS", "3"))
+RETRIEVAL_MAX_BATCH_SIZE = int(os.getenv("RETRIEVAL_MAX_BATCH_SIZE", "32"))
+RETRIEVAL_MAX_QUEUE_SIZE = int(os.getenv("RETRIEVAL_MAX_QUEUE_SIZE", "1024"))
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "2"))
+
+# Resident knowledge base settings
+KNOWLEDGE_BASE_PATH = os.getenv("KNOWLEDGE_BASE_PATH")
+KNOWLEDGE_BASE_RELOAD_INTERVAL = float(os.getenv("KNOWLEDGE_BASE_RELOAD_INTERVAL", "30"))
+
+class RetrievalQueueFull(Exception):
+    """Raised when the retrieval queue is at capacity"""
+    pass
+
+class RetrievalExecutor:
+    """
+    Runs knowledge base searches off the event loop.
+
+    Queries arriving within a few milliseconds of each other are collected into
+    a micro-batch and handed to KnowledgeBase.search_batch on a worker thread, so
+    the embedding model encodes them together and FAISS searches them in one call.
+    Threads are used rather than processes because both torch and FAISS release
+    the GIL during the heavy work and the index can then stay in one place.
+    """
+    def __init__(
+        self,
+        knowledge_base: KnowledgeBase,
+        batch_window_ms: float = RETRIEVAL_BATCH_WINDOW_MS,
+        max_batch_size: int = RETRIEVAL_MAX_BATCH_SIZE,
+        max_queue_size: int = RETRIEVAL_MAX_QUEUE_SIZE,
+        max_workers: int = RETRIEVAL_WORKERS
+    ):
+        self.knowledge_base = knowledge_base
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.max_queue_size = max_queue_size
+        self.max_workers = max_workers
+
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="retrieval")
+        self._queue: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._batcher: Optional[asyncio.Task] = None
+
+        # Pre-bind metric children so the hot path skips label lookups
+        self._queue_latency = RETRIEVAL_LATENCY.labels(app_name=APP_NAME, phase="queue")
+        self._search_latency = RETRIEVAL_LATENCY.labels(app_name=APP_NAME, phase="search")
+        self._total_latency = RETRIEVAL_LATENCY.labels(app_name=APP_NAME, phase="total")
+        self._batch_size = RETRIEVAL_BATCH_SIZE.labels(app_name=APP_NAME)
+        self._queue_depth = RETRIEVAL_QUEUE_DEPTH.labels(app_name=APP_NAME)
+        self._rejected = RETRIEVAL_REJECTED.labels(app_name=APP_NAME)
+
+    def _ensure_started(self):
+        """Create the queue and batcher task on the running loop"""
+        if self._batcher is None or self._batcher.done():
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._slots = asyncio.Semaphore(self.max_workers)
+            self._batcher = asyncio.get_running_loop().create_task(self._batch_loop())
+
+    async def search(
+        self,
+        query: str,
+        k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+        mode: str = "vector"
+    ) -> List[Document]:
+        """Search the knowledge base without blocking the event loop"""
+        self._ensure_started()
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((query, k, filters, mode, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self._rejected.inc()
+            raise RetrievalQueueFull(f"Retrieval queue is full ({self.max_queue_size} pending queries)")
+
+        self._queue_depth.set(self._queue.qsize())
+        return await future
+
+    async def _batch_loop(self):
+        """Collect queued queries into micro-batches and dispatch them"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+
+            # Keep collecting until the window closes or the batch is full
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            self._queue_depth.set(self._queue.qsize())
+
+            # Bound the number of batches in flight to the worker count
+            await self._slots.acquire()
+            loop.create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        """Run one micro-batch on the worker pool and resolve its futures"""
+        try:
+            dispatched_at = time.perf_counter()
+            for *_, enqueued_at in batch:
+                self._queue_latency.observe(dispatched_at - enqueued_at)
+            self._batch_size.observe(len(batch))
+
+            # search_batch takes one mode per call, so split the batch by mode
+            by_mode = defaultdict(list)
+            for item in batch:
+                by_mode[item[3]].append(item)
+
+            await asyncio.gather(*(self._run_group(mode, items, dispatched_at) for mode, items in by_mode.items()))
+        finally:
+            self._slots.release()
+
+    async def _run_group(self, mode: str, items, dispatched_at: float):
+        """Search one group of same-mode queries and resolve their futures"""
+        loop = asyncio.get_running_loop()
+        queries = [query for query, *_ in items]
+        filters = [query_filters for _, _, query_filters, *_ in items]
+        k = max(query_k for _, query_k, *_ in items)
+
+        try:
+            results = await loop.run_in_executor(
+                self._pool, self.knowledge_base.search_batch, queries, k, filters, mode
+            )
+        except Exception as e:
+            logger.error(f"Error in retrieval batch: {str(e)}")
+            for *_, future, _ in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        finished_at = time.perf_counter()
+        self._search_latency.observe(finished_at - dispatched_at)
+
+        for (_, query_k, _, _, future, enqueued_at), documents in zip(items, results):
+            self._total_latency.observe(finished_at - enqueued_at)
+            if not future.done():
+                future.set_result(documents[:query_k])
+
+    async def close(self):
+        """Stop the batcher and shut down the worker pool"""
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            self._batcher = None
+
+        # Fail queries that never made it into a batch rather than leaving them hanging
+        while self._queue is not None and not self._queue.empty():
+            *_, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Retrieval executor closed"))
+
+        self._pool.shutdown(wait=False)
+
+class ResidentKnowledgeBase:
+    """
+    Knowledge base loaded once per process and searched through a RetrievalExecutor.
+
+    Every reload_interval seconds a search checks the modification time of the
+    saved files; if they changed, the new index is loaded on a background thread
+    and swapped in while the old one keeps serving.
+    """
+    def __init__(self, path: str, reload_interval: float = KNOWLEDGE_BASE_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.executor: Optional[RetrievalExecutor] = None
+        self._loaded_mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._reloading = False
+        self._load_lock = threading.Lock()
+
+    def _files_mtime(self) -> float:
+        """Latest modification time of the saved index and documents"""
+        return max(os.stat(f"{self.path}.index").st_mtime, os.stat(f"{self.path}.json").st_mtime)
+
+    def reload(self, force: bool = False) -> bool:
+        """Load the knowledge base from disk if it changed since the last load"""
+        with self._load_lock:
+            mtime = self._files_mtime()
+            if not force and self.executor is not None and mtime == self._loaded_mtime:
+                return False
+
+            knowledge_base = KnowledgeBase.load(self.path)
+            if self.executor is None:
+                self.executor = RetrievalExecutor(knowledge_base)
+            else:
+                # Searches already dispatched finish on the old index
+                self.executor.knowledge_base = knowledge_base
+            self._loaded_mtime = mtime
+            logger.info(f"Knowledge base loaded from {self.path} ({len(knowledge_base.documents)} documents)")
+            return True
+
+    def _reload_in_background(self):
+        try:
+            self.reload()
+        except Exception as e:
+            logger.error(f"Error reloading knowledge base: {str(e)}")
+        finally:
+            self._reloading = False
+
+    def _maybe_schedule_reload(self):
+        """Check for a newer index at most once per reload interval"""
+        now = time.monotonic()
+        if self._reloading or now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            changed = self._files_mtime() != self._loaded_mtime
+        except OSError:
+            return
+        if changed:
+            self._reloading = True
+            asyncio.get_running_loop().run_in_executor(None, self._reload_in_background)
+
+    async def search(
+        self,
+        query: str,
+        k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+        mode: str = "vector"
+    ) -> List[Document]:
+        """Search the resident knowledge base, loading it first if needed"""
+        if self.executor is None:
+            await asyncio.get_running_loop().run_in_executor(None, self.reload)
+        else:
+            self._maybe_schedule_reload()
+        return await self.executor.search(query, k=k, filters=filters, mode=mode)
+
+    def memory_bytes(self) -> int:
+        """Estimated memory held by the loaded knowledge base"""
+        if self.executor is None:
+            return 0
+        return self.executor.knowledge_base.estimated_memory_bytes()
+
+    async def close(self):
+        """Release the worker pool; the knowledge base is freed with this object"""
+        if self.executor is not None:
+            await self.executor.close()
+            self.executor = None
+
+_resident_knowledge_base: Optional[ResidentKnowledgeBase] = None
+
+def get_resident_knowledge_base() -> Optional[ResidentKnowledgeBase]:
+    """Return this process's knowledge base, or None if KNOWLEDGE_BASE_PATH is not set"""
+    global _resident_knowledge_base
+    if _resident_knowledge_base is None and KNOWLEDGE_BASE_PATH:
+        _resident_knowledge_base = ResidentKnowledgeBase(KNOWLEDGE_BASE_PATH)
+    return _resident_knowledge_base
@@ -0,0 +1,222 @@
+import sys
+import html
+import logging
+from typing import Any, Dict, List
+
+from sqlalchemy import text
+
+from app.migrate import create_index_concurrently
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SNIPPET_WORDS = 20
+# Private-use characters mark matches in raw snippets; they become <b></b> only after escaping
+MARK_START = "\ue000"
+MARK_END = "\ue001"
+BACKFILL_BATCH_SIZE = 10000
+
+def setup_search_index(engine, batch_size: int = BACKFILL_BATCH_SIZE):
+    """
+    Create the full-text index over message content if it doesn't exist yet.
+    Run once per deploy with ``python -m app.search --setup``, never from app startup.
+
+    PostgreSQL: a tsvector column filled by a trigger on insert/update,
+    backfilled in batches, then a GIN index (combined with user_id via
+    btree_gin when available) built CONCURRENTLY, so writes continue
+    throughout. SQLite: an FTS5 table kept in sync with triggers, keyed by
+    messages_fts_ids, which gives each message a stable integer id.
+    """
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        _setup_postgres(engine, batch_size)
+    elif dialect == "sqlite":
+        _setup_sqlite(engine)
+    else:
+        logger.info(f"No full-text index for {dialect}; search falls back to LIKE scans")
+
+def _setup_postgres(engine, batch_size: int):
+    # A nullable column without a default is a catalog-only change (no table
+    # rewrite); lock_timeout keeps the brief exclusive lock from queueing
+    # behind long transactions and stalling other writers
+    with engine.begin() as conn:
+        conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+        conn.execute(text("ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector"))
+        conn.execute(text("""
+            CREATE OR REPLACE FUNCTION messages_search_vector_update() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector := to_tsvector('english', coalesce(NEW.content, ''));
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+        """))
+        conn.execute(text("DROP TRIGGER IF EXISTS messages_search_vector_update ON messages"))
+        conn.execute(text(
+            "CREATE TRIGGER messages_search_vector_update BEFORE INSERT OR UPDATE OF content "
+            "ON messages FOR EACH ROW EXECUTE FUNCTION messages_search_vector_update()"
+        ))
+
+    _backfill_postgres(engine, batch_size)
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        # A (user_id, search_vector) index lets one index scan both scope and match
+        try:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gin"))
+            create_index_concurrently(conn, "ix_messages_user_search", "messages USING GIN (user_id, search_vector)")
+        except Exception as e:
+            logger.info(f"btree_gin unavailable ({str(e)}); indexing search_vector alone")
+            create_index_concurrently(conn, "ix_messages_search", "messages USING GIN (search_vector)")
+
+def _backfill_postgres(engine, batch_size: int):
+    """Fill search_vector for existing rows in short transactions, walking the primary key"""
+    last_id = ""
+    filled = 0
+    while True:
+        with engine.begin() as conn:
+            batch_end = conn.execute(text(
+                "SELECT max(id) FROM (SELECT id FROM messages WHERE id > :last_id ORDER BY id LIMIT :batch_size) batch"
+            ), {"last_id": last_id, "batch_size": batch_size}).scalar()
+            if batch_end is None:
+                break
+            result = conn.execute(text(
+                "UPDATE messages SET search_vector = to_tsvector('english', coalesce(content, '')) "
+                "WHERE id > :last_id AND id <= :batch_end AND search_vector IS NULL"
+            ), {"last_id": last_id, "batch_end": batch_end})
+        filled += result.rowcount
+        last_id = batch_end
+    logger.info(f"Backfilled search vectors for {filled} messages")
+
+def _setup_sqlite(engine):
+    # FTS5 rows need an integer rowid. messages has a string key, and its
+    # implicit rowid can be renumbered by VACUUM, so each message gets a
+    # stable id in messages_fts_ids instead
+    with engine.begin() as conn:
+        current = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts_ids'"
+        )).first()
+        if current:
+            return
+
+        # Replace the earlier layout, an external-content table on messages.rowid
+        for trigger in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update"):
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+        conn.execute(text("DROP TABLE IF EXISTS messages_fts"))
+
+        conn.execute(text(
+            "CREATE TABLE messages_fts_ids ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT NOT NULL UNIQUE)"
+        ))
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE messages_fts USING fts5(content, tokenize='porter unicode61')"
+        ))
+        conn.execute(text(
+            "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+            "INSERT INTO messages_fts_ids(message_id) VALUES (new.id); "
+            "INSERT INTO messages_fts(rowid, content) "
+            "SELECT id, new.content FROM messages_fts_ids WHERE message_id = new.id; END"
+        ))
+        conn.execute(text(
+            "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+            "DELETE FROM messages_fts WHERE rowid = "
+            "(SELECT id FROM messages_fts_ids WHERE message_id = old.id); "
+            "DELETE FROM messages_fts_ids WHERE message_id = old.id; END"
+        ))
+        conn.execute(text(
+            "CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN "
+            "UPDATE messages_fts SET content = new.content WHERE rowid = "
+            "(SELECT id FROM messages_fts_ids WHERE message_id = new.id); END"
+        ))
+        # Index messages written before the table existed
+        conn.execute(text("INSERT INTO messages_fts_ids(message_id) SELECT id FROM messages"))
+        conn.execute(text(
+            "INSERT INTO messages_fts(rowid, content) "
+            "SELECT ids.id, m.content FROM messages_fts_ids ids JOIN messages m ON m.id = ids.message_id"
+        ))
+
+def _fts5_query(query: str) -> str:
+    """Quote each term so user input can't be parsed as FTS5 syntax"""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+_POSTGRES_SEARCH = text("""
+    WITH hits AS (
+        SELECT m.id, m.conversation_id, m.role, m.created_at, m.content,
+               ts_rank_cd(m.search_vector, q) AS rank
+        FROM messages m, websearch_to_tsquery('english', :query) q
+        WHERE m.user_id = :user_id AND m.search_vector @@ q
+        ORDER BY rank DESC, m.created_at DESC
+        LIMIT :limit OFFSET :offset
+    )
+    SELECT hits.id, hits.conversation_id, c.title, hits.role, hits.created_at, hits.rank,
+           ts_headline('english', hits.content, websearch_to_tsquery('english', :query),
+                       :headline_options) AS snippet
+    FROM hits JOIN conversations c ON c.id = hits.conversation_id
+    ORDER BY hits.rank DESC, hits.created_at DESC
+""")
+
+_SQLITE_SEARCH = text(f"""
+    SELECT m.id, m.conversation_id, c.title, m.role, m.created_at,
+           -bm25(messages_fts) AS rank,
+           snippet(messages_fts, 0, :mark_start, :mark_end, '...', {SNIPPET_WORDS}) AS snippet
+    FROM messages_fts
+    JOIN messages_fts_ids ids ON ids.id = messages_fts.rowid
+    JOIN messages m ON m.id = ids.message_id
+    JOIN conversations c ON c.id = m.conversation_id
+    WHERE messages_fts MATCH :query AND m.user_id = :user_id
+    ORDER BY bm25(messages_fts), m.created_at DESC
+    LIMIT :limit OFFSET :offset
+""")
+
+_LIKE_SEARCH = text("""
+    SELECT m.id, m.conversation_id, c.title, m.role, m.created_at, 0 AS rank,
+           substr(m.content, 1, 200) AS snippet
+    FROM messages m JOIN conversations c ON c.id = m.conversation_id
+    WHERE m.user_id = :user_id AND m.content LIKE :query
+    ORDER BY m.created_at DESC
+    LIMIT :limit OFFSET :offset
+""")
+
+def _render_snippet(snippet: str) -> str:
+    """HTML-escape message text, then turn the match markers into <b></b>"""
+    return html.escape(snippet).replace(MARK_START, "<b>").replace(MARK_END, "</b>")
+
+def search_messages(db, user_id: str, query: str, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+    """Ranked full-text search over one user's messages, returning a page of HTML-safe snippets"""
+    dialect = db.get_bind().dialect.name
+    params = {"user_id": user_id, "query": query, "limit": limit, "offset": offset}
+    if dialect == "postgresql":
+        statement = _POSTGRES_SEARCH
+        params["headline_options"] = (
+            f"MaxFragments=2, MaxWords={SNIPPET_WORDS}, MinWords=5, "
+            f"StartSel={MARK_START}, StopSel={MARK_END}"
+        )
+    elif dialect == "sqlite":
+        statement = _SQLITE_SEARCH
+        params["query"] = _fts5_query(query)
+        params["mark_start"] = MARK_START
+        params["mark_end"] = MARK_END
+    else:
+        statement = _LIKE_SEARCH
+        params["query"] = f"%{query}%"
+
+    rows = db.execute(statement, params).all()
+    return [
+        {
+            "message_id": row.id,
+            "conversation_id": row.conversation_id,
+            "conversation_title": row.title,
+            "role": row.role,
+            "created_at": row.created_at,
+            "rank": float(row.rank),
+            "snippet": _render_snippet(row.snippet or ""),
+        }
+        for row in rows
+    ]
+
+if __name__ == "__main__":
+    # Usage: python -m app.search --setup
+    if sys.argv[1:] != ["--setup"]:
+        sys.exit("Usage: python -m app.search --setup")
+    from app.database import engine
+    setup_search_index(engine)
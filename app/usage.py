@@ -0,0 +1,234 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Tuple
+
+import redis
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from app.database import SessionLocal
+from app.models import TokenUsage, UsageFlush
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Total tokens a user may consume per UTC day; 0 disables the quota
+USER_DAILY_TOKEN_QUOTA = int(os.getenv("USER_DAILY_TOKEN_QUOTA", "0"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "30"))
+
+PENDING_KEY = "usage:pending"
+# Flushing keys are named usage:flushing:<unix time>:<uuid>; one older than
+# this was left behind by a process that died mid-flush
+FLUSHING_KEY_PREFIX = "usage:flushing:"
+STRANDED_FLUSH_AGE = float(os.getenv("USAGE_STRANDED_FLUSH_AGE", "300"))
+USAGE_RECOVERY_INTERVAL = float(os.getenv("USAGE_RECOVERY_INTERVAL", "600"))
+# Records of applied flushes are kept this long; far beyond any key's life in Redis
+APPLIED_FLUSH_RETENTION_DAYS = 7
+DAILY_KEY_TTL = 2 * 24 * 3600
+
+def _daily_key(user_id: str, day: str) -> str:
+    return f"usage:daily:{user_id}:{day}"
+
+def record_user_usage(redis_client, user_id: str, model: str, prompt_tokens: int, completion_tokens: int):
+    """
+    Add a provider call's tokens to the user's counters in one Redis round trip:
+    the daily total read by quota checks, and the pending ledger entries that
+    flush_usage() later writes to the database.
+    """
+    day = datetime.utcnow().date().isoformat()
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hincrby(PENDING_KEY, f"{user_id}|{model}|{day}|prompt", prompt_tokens)
+        pipe.hincrby(PENDING_KEY, f"{user_id}|{model}|{day}|completion", completion_tokens)
+        pipe.incrby(_daily_key(user_id, day), prompt_tokens + completion_tokens)
+        pipe.expire(_daily_key(user_id, day), DAILY_KEY_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error recording token usage: {str(e)}")
+
+def tokens_used_today(redis_client, user_id: str) -> int:
+    """Tokens the user has consumed today, from the Redis counter only"""
+    value = redis_client.get(_daily_key(user_id, datetime.utcnow().date().isoformat()))
+    return int(value) if value else 0
+
+def check_quota(redis_client, user_id: str) -> Tuple[bool, int]:
+    """
+    Whether the user is still under USER_DAILY_TOKEN_QUOTA, and the seconds
+    until the quota resets. Fails open if Redis is unavailable.
+    """
+    if USER_DAILY_TOKEN_QUOTA <= 0:
+        return True, 0
+    try:
+        used = tokens_used_today(redis_client, user_id)
+    except Exception as e:
+        logger.error(f"Error reading token usage: {str(e)}")
+        return True, 0
+    now = datetime.utcnow()
+    reset_in = int((datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds())
+    return used < USER_DAILY_TOKEN_QUOTA, reset_in
+
+def _parse_pending(entries: Dict[bytes, bytes]) -> Dict[Tuple[str, str, str], Dict[str, int]]:
+    totals = defaultdict(lambda: {"prompt": 0, "completion": 0})
+    for field, value in entries.items():
+        user_id, rest = field.decode().split("|", 1)
+        model, day, kind = rest.rsplit("|", 2)
+        totals[(user_id, model, day)][kind] += int(value)
+    return totals
+
+def _upsert_usage(db, totals):
+    rows = [
+        {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "model": model,
+            "period": date.fromisoformat(day),
+            "prompt_tokens": counts["prompt"],
+            "completion_tokens": counts["completion"],
+            "updated_at": datetime.utcnow()
+        }
+        for (user_id, model, day), counts in totals.items()
+    ]
+
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = insert(TokenUsage).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["user_id", "model", "period"],
+            set_={
+                "prompt_tokens": TokenUsage.prompt_tokens + stmt.excluded.prompt_tokens,
+                "completion_tokens": TokenUsage.completion_tokens + stmt.excluded.completion_tokens,
+                "updated_at": stmt.excluded.updated_at
+            }
+        )
+        db.execute(stmt)
+        return
+
+    for row in rows:
+        usage = db.query(TokenUsage).filter(
+            TokenUsage.user_id == row["user_id"],
+            TokenUsage.model == row["model"],
+            TokenUsage.period == row["period"]
+        ).first()
+        if usage is None:
+            db.add(TokenUsage(**row))
+        else:
+            usage.prompt_tokens += row["prompt_tokens"]
+            usage.completion_tokens += row["completion_tokens"]
+
+def _new_flushing_key() -> str:
+    return f"{FLUSHING_KEY_PREFIX}{int(time.time())}:{uuid.uuid4()}"
+
+def _apply_flush(redis_client, flushing_key: str) -> int:
+    """
+    Write one flushing hash to the token_usage ledger exactly once, then delete
+    it. The key is recorded in usage_flushes in the same transaction as the
+    counters, so retrying a flush that committed before the key was deleted
+    only deletes the key. On any other error the key is left for
+    recover_stranded_flushes() to retry. Returns the number of ledger rows written.
+    """
+    totals = _parse_pending(redis_client.hgetall(flushing_key))
+    db = SessionLocal()
+    try:
+        db.add(UsageFlush(id=flushing_key))
+        try:
+            # Blocks while another process applies the same key, then fails if it committed
+            db.flush()
+        except IntegrityError:
+            db.rollback()
+            logger.info(f"Usage flush {flushing_key} was already applied")
+            redis_client.delete(flushing_key)
+            return 0
+        if totals:
+            _upsert_usage(db, totals)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error flushing token usage: {str(e)}")
+        return 0
+    finally:
+        db.close()
+
+    redis_client.delete(flushing_key)
+    return len(totals)
+
+def _prune_applied_flushes():
+    db = SessionLocal()
+    try:
+        db.query(UsageFlush).filter(
+            UsageFlush.applied_at < datetime.utcnow() - timedelta(days=APPLIED_FLUSH_RETENTION_DAYS)
+        ).delete(synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error pruning applied usage flushes: {str(e)}")
+    finally:
+        db.close()
+
+def recover_stranded_flushes(redis_client) -> int:
+    """
+    Apply flushes that never finished: the process died, or the database
+    failed, between renaming the pending hash and deleting it. Flushes are
+    recorded as applied in the same transaction as their counters, so one
+    that committed before the crash is deleted, not counted again, even if
+    a slow original flush is still running. Returns the number of keys handled.
+    """
+    recovered = 0
+    cutoff = time.time() - STRANDED_FLUSH_AGE
+    for key in redis_client.scan_iter(match=f"{FLUSHING_KEY_PREFIX}*", count=1000):
+        key = key.decode()
+        try:
+            created_at = int(key[len(FLUSHING_KEY_PREFIX):].split(":", 1)[0])
+        except ValueError:
+            created_at = 0  # keys from before timestamps were added
+        if created_at > cutoff:
+            continue  # probably a flush still in progress
+        _apply_flush(redis_client, key)
+        recovered += 1
+
+    if recovered:
+        logger.info(f"Recovered {recovered} stranded usage flushes")
+    _prune_applied_flushes()
+    return recovered
+
+def flush_usage(redis_client) -> int:
+    """
+    Move pending usage counters from Redis into the token_usage ledger in a
+    single transaction. The pending hash is renamed first, so increments that
+    arrive during the flush start a fresh hash. If the write fails the renamed
+    hash stays in Redis and recovery applies it later. Returns the number of
+    ledger rows written.
+    """
+    flushing_key = _new_flushing_key()
+    try:
+        redis_client.rename(PENDING_KEY, flushing_key)
+    except redis.exceptions.ResponseError:
+        return 0  # nothing pending
+
+    return _apply_flush(redis_client, flushing_key)
+
+async def run_usage_flusher(redis_client, interval: float = USAGE_FLUSH_INTERVAL):
+    """
+    Flush usage counters every interval seconds, off the event loop. Stranded
+    flushes are recovered at startup and every USAGE_RECOVERY_INTERVAL seconds.
+    """
+    loop = asyncio.get_running_loop()
+    recovered_at = None
+    while True:
+        try:
+            if recovered_at is None or time.monotonic() - recovered_at >= USAGE_RECOVERY_INTERVAL:
+                recovered_at = time.monotonic()
+                await loop.run_in_executor(None, recover_stranded_flushes, redis_client)
+        except Exception as e:
+            logger.error(f"Error recovering usage flushes: {str(e)}")
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(None, flush_usage, redis_client)
+        except Exception as e:
+            logger.error(f"Error in usage flusher: {str(e)}")
@@ -0,0 +1,350 @@
+"""
+Offline end-to-end benchmark for the chat API.
+
+Runs the FastAPI app under uvicorn on localhost against SQLite (or any
+DATABASE_URL), fakeredis, a simulated LLM provider and a synthetic knowledge
+base, drives it with concurrent simulated users, and reports throughput and
+p50/p95/p99 latency per endpoint and per pipeline stage.
+
+Usage:
+    python benchmarks/run_benchmarks.py --users 50 --turns 5 --output results.json
+    python benchmarks/run_benchmarks.py --users 50 --turns 5 --compare results.json
+
+Needs the app's own requirements plus fakeredis, httpx and uvicorn.
+"""
+import os
+import sys
+import json
+import math
+import time
+import hashlib
+import socket
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import statistics
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = (
+    "account billing error invoice model token context latency cache index query "
+    "payment refund order shipping product warranty update password login export"
+).split()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test for the chat API")
+    parser.add_argument("--users", type=int, default=20, help="Concurrent simulated users")
+    parser.add_argument("--conversations", type=int, default=2, help="Conversations per user")
+    parser.add_argument("--turns", type=int, default=5, help="Messages per conversation")
+    parser.add_argument("--message-words", type=int, default=30, help="Mean words per user message")
+    parser.add_argument("--llm-latency-ms", type=float, default=300, help="Mean simulated provider latency")
+    parser.add_argument("--llm-ms-per-token", type=float, default=2, help="Simulated generation time per completion token")
+    parser.add_argument("--completion-words", type=int, default=120, help="Mean words per simulated reply")
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="Seconds between reply polls")
+    parser.add_argument("--reply-timeout", type=float, default=30, help="Seconds to wait for each reply")
+    parser.add_argument("--kb-docs", type=int, default=2000, help="Synthetic knowledge base size (0 disables RAG)")
+    parser.add_argument("--kb-queries", type=int, default=500, help="Direct KnowledgeBase.search calls to time")
+    parser.add_argument("--database-url", default=None, help="Defaults to a fresh SQLite file")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="Write results as JSON to this path")
+    parser.add_argument("--compare", default=None, help="Baseline results JSON to diff against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed relative p95 increase before failing")
+    return parser.parse_args()
+
+def synthetic_text(rng: random.Random, mean_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(max(1, int(rng.expovariate(1 / mean_words)))))
+
+def configure_environment(args, workdir: str):
+    """Point the app at offline resources; must run before any app module is imported"""
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["TRACE_EXPORTER"] = "file"
+    os.environ["TRACE_FILE"] = os.path.join(workdir, "traces.jsonl")
+    os.environ.pop("KNOWLEDGE_BASE_DIR", None)
+    if args.kb_docs:
+        os.environ["KNOWLEDGE_BASE_PATH"] = os.path.join(workdir, "kb")
+    else:
+        os.environ.pop("KNOWLEDGE_BASE_PATH", None)
+
+class HashEmbeddingModel:
+    """Deterministic stand-in for the sentence transformer"""
+    def __init__(self, dimension: int = 384):
+        self.dimension = dimension
+
+    def encode(self, sentences, batch_size: int = 32):
+        import numpy as np
+        single = isinstance(sentences, str)
+        vectors = np.stack([
+            np.random.default_rng(int(hashlib.sha256(sentence.encode()).hexdigest()[:8], 16))
+            .standard_normal(self.dimension).astype(np.float32)
+            for sentence in ([sentences] if single else sentences)
+        ])
+        return vectors[0] if single else vectors
+
+def build_synthetic_kb(path: str, n_docs: int, rng: random.Random):
+    from app.advanced_llm import Document, KnowledgeBase
+    kb = KnowledgeBase()
+    documents = [
+        Document(
+            id=f"doc-{i}",
+            content=synthetic_text(rng, 80),
+            metadata={"category": rng.choice(["billing", "shipping", "account"])}
+        )
+        for i in range(n_docs)
+    ]
+    for start in range(0, n_docs, 256):
+        kb.add_documents(documents[start:start + 256])
+    kb.save(path)
+    return kb
+
+def percentile(sorted_values, q: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, min(len(sorted_values) - 1, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize(samples, errors: int, duration: float):
+    values = sorted(samples)
+    if not values:
+        return {"count": 0, "errors": errors}
+    return {
+        "count": len(values),
+        "errors": errors,
+        "throughput_rps": round(len(values) / duration, 2) if duration else None,
+        "mean_ms": round(statistics.fmean(values) * 1000, 3),
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name: str, seconds: float, ok: bool = True):
+        if ok:
+            self.samples[name].append(seconds)
+        else:
+            self.errors[name] += 1
+
+    def summary(self, duration: float):
+        names = sorted(set(self.samples) | set(self.errors))
+        return {name: summarize(self.samples[name], self.errors[name], duration) for name in names}
+
+async def run_user(client, user_id: str, args, rng: random.Random, recorder: Recorder):
+    """One simulated user: send a message, poll until the reply appears, repeat"""
+    headers = {"X-Bench-User": user_id}
+    for _ in range(args.conversations):
+        conversation_id = None
+        for turn in range(args.turns):
+            turn_started = time.perf_counter()
+            payload = {"content": synthetic_text(rng, args.message_words), "conversation_id": conversation_id}
+
+            started = time.perf_counter()
+            response = await client.post("/api/messages/", json=payload, headers=headers)
+            recorder.record("POST /api/messages/", time.perf_counter() - started, response.status_code == 200)
+            if response.status_code != 200:
+                break
+            conversation_id = response.json()["conversation_id"]
+
+            replied = False
+            deadline = time.perf_counter() + args.reply_timeout
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                response = await client.get("/api/conversations/", headers=headers)
+                recorder.record("GET /api/conversations/", time.perf_counter() - started, response.status_code == 200)
+                if response.status_code == 200:
+                    conversation = next((c for c in response.json() if c["id"] == conversation_id), None)
+                    assistant_count = sum(1 for m in (conversation or {}).get("messages", []) if m["role"] == "assistant")
+                    if assistant_count > turn:
+                        replied = True
+                        break
+                await asyncio.sleep(args.poll_interval)
+
+            recorder.record("turn (send to reply visible)", time.perf_counter() - turn_started, replied)
+
+async def benchmark_knowledge_base(kb, args, rng: random.Random, recorder: Recorder):
+    """Time direct searches and concurrent searches through the micro-batching executor"""
+    from app.retrieval import RetrievalExecutor
+
+    queries = [synthetic_text(rng, 8) for _ in range(args.kb_queries)]
+    for mode in ("vector", "hybrid"):
+        for query in queries:
+            started = time.perf_counter()
+            kb.search(query, k=5, mode=mode)
+            recorder.record(f"KnowledgeBase.search ({mode})", time.perf_counter() - started)
+
+    executor = RetrievalExecutor(kb)
+
+    async def timed_search(query):
+        started = time.perf_counter()
+        try:
+            await executor.search(query, k=5, mode="hybrid")
+            recorder.record("RetrievalExecutor.search (hybrid, concurrent)", time.perf_counter() - started)
+        except Exception:
+            recorder.record("RetrievalExecutor.search (hybrid, concurrent)", 0, ok=False)
+
+    await asyncio.gather(*(timed_search(query) for query in queries))
+    await executor.close()
+
+def read_stage_samples(trace_file: str, recorder: Recorder):
+    """Collect per-stage durations from the JSON-lines trace file"""
+    if not os.path.exists(trace_file):
+        return
+    with open(trace_file) as f:
+        for line in f:
+            span = json.loads(line)
+            recorder.record(span["stage"], span["duration"], span.get("error") is None)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def compare(results, baseline_path: str, max_regression: float) -> bool:
+    """Print p95 changes against a baseline run; return False on regressions"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    ok = True
+    print(f"\n{'metric':<55} {'base p95':>10} {'new p95':>10} {'change':>8}")
+    for section in ("endpoints", "stages", "knowledge_base"):
+        for name, current in results.get(section, {}).items():
+            previous = baseline.get(section, {}).get(name)
+            if not previous or not previous.get("p95_ms") or not current.get("p95_ms"):
+                continue
+            change = current["p95_ms"] / previous["p95_ms"] - 1
+            flag = ""
+            if change > max_regression:
+                flag = "  REGRESSION"
+                ok = False
+            print(f"{name:<55} {previous['p95_ms']:>10.1f} {current['p95_ms']:>10.1f} {change:>+7.0%}{flag}")
+    return ok
+
+async def run(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="chatapp-bench-")
+    configure_environment(args, workdir)
+
+    try:
+        import fakeredis
+        import httpx
+        import uvicorn
+    except ImportError as e:
+        sys.exit(f"Benchmark dependency missing: {e.name} (pip install fakeredis httpx uvicorn)")
+
+    from fastapi import Request
+    from app import embeddings, llm_service
+    from app import main as app_main
+    from app.auth import User, get_current_user
+    from app.database import SessionLocal
+    from app.models import User as DBUser
+
+    # Offline stand-ins for Redis, the embedding model and the LLM provider
+    fake_redis = fakeredis.FakeRedis()
+    llm_service.redis_client = fake_redis
+    app_main.redis_client = fake_redis
+    embeddings._model = HashEmbeddingModel()
+
+    provider_rng = random.Random(f"{args.seed}-provider")
+
+    class SimulatedLLMClient(llm_service.BaseLLMClient):
+        """Sleeps like a provider would and reports token usage"""
+        async def generate_response(self, messages):
+            prompt_tokens = sum(self.count_tokens(m["content"]) for m in messages)
+            reply = synthetic_text(provider_rng, args.completion_words)
+            completion_tokens = self.count_tokens(reply)
+            latency = provider_rng.lognormvariate(0, 0.5) * args.llm_latency_ms + completion_tokens * args.llm_ms_per_token
+            await asyncio.sleep(latency / 1000)
+            self.last_usage = (prompt_tokens, completion_tokens)
+            return reply
+
+        def count_tokens(self, text):
+            return max(1, len(text) // 4)
+
+    app_main.get_llm_client = lambda model_name: SimulatedLLMClient(api_key="", model_name="gpt-3.5-turbo")
+
+    kb = None
+    if args.kb_docs:
+        kb = build_synthetic_kb(os.environ["KNOWLEDGE_BASE_PATH"], args.kb_docs, rng)
+
+    # Authenticate by header so no password hashing skews the numbers
+    user_ids = [f"bench-user-{i}" for i in range(args.users)]
+    db = SessionLocal()
+    for user_id in user_ids:
+        if not db.get(DBUser, user_id):
+            db.add(DBUser(id=user_id, username=user_id, email=f"{user_id}@example.com", hashed_password=""))
+    db.commit()
+    db.close()
+
+    async def bench_user(request: Request) -> User:
+        user_id = request.headers["X-Bench-User"]
+        return User(id=user_id, username=user_id, email=f"{user_id}@example.com")
+
+    app_main.app.dependency_overrides[get_current_user] = bench_user
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app_main.app, host="127.0.0.1", port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.users * 2)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            run_user(client, user_id, args, random.Random(f"{args.seed}-{user_id}"), recorder)
+            for user_id in user_ids
+        ))
+        load_duration = time.perf_counter() - started
+
+    server.should_exit = True
+    await server_task
+
+    stage_recorder = Recorder()
+    read_stage_samples(os.environ["TRACE_FILE"], stage_recorder)
+
+    kb_recorder = Recorder()
+    if kb is not None:
+        kb_started = time.perf_counter()
+        await benchmark_knowledge_base(kb, args, rng, kb_recorder)
+        kb_duration = time.perf_counter() - kb_started
+    else:
+        kb_duration = 0
+
+    completed_turns = len(recorder.samples["turn (send to reply visible)"])
+    return {
+        "config": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": os.environ["DATABASE_URL"].split(":", 1)[0],
+        },
+        "duration_s": round(load_duration, 3),
+        "turns_per_second": round(completed_turns / load_duration, 2) if load_duration else None,
+        "endpoints": recorder.summary(load_duration),
+        "stages": stage_recorder.summary(load_duration),
+        "knowledge_base": kb_recorder.summary(kb_duration),
+    }
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+
+    print(json.dumps({key: results[key] for key in ("duration_s", "turns_per_second", "endpoints", "stages", "knowledge_base")}, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare and not compare(results, args.compare, args.max_regression):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
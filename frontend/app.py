@@ -1,9 +1,9 @@
 # frontend/app.py
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import json
 from datetime import datetime
-import time
 import os
 
 # API endpoint
@@ -26,17 +26,72 @@ if "conversation_id" not in st.session_state:
 if "token" not in st.session_state:
     st.session_state.token = None
 
+# Conversation list, plus per-conversation message cache, sync cursor and ETag for delta fetches
+if "conversations" not in st.session_state:
+    st.session_state.conversations = None
+
+if "message_cache" not in st.session_state:
+    st.session_state.message_cache = {}
+
+if "cursors" not in st.session_state:
+    st.session_state.cursors = {}
+
+if "etags" not in st.session_state:
+    st.session_state.etags = {}
+
+def get_session():
+    """Pooled HTTP session kept across reruns so connections are reused"""
+    if "http" not in st.session_state:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        st.session_state.http = session
+    return st.session_state.http
+
+def open_conversation(conversation_id=None):
+    """Switch to a conversation, showing its cached messages (none for a new conversation)"""
+    st.session_state.conversation_id = conversation_id
+    if conversation_id:
+        st.session_state.messages = st.session_state.message_cache.setdefault(conversation_id, [])
+    else:
+        st.session_state.messages = []
+
+def advance_cursor(conversation_id, response):
+    """
+    Move the sync cursor past a message the API just returned, but only if the
+    cursor sits on the message before it. Otherwise we've missed messages
+    (another tab, a reply that arrived after we stopped waiting), so fetch
+    the delta instead.
+    """
+    cursor = response.headers.get("X-Cursor")
+    if not cursor:
+        return
+    if st.session_state.cursors.get(conversation_id) == response.headers.get("X-Previous-Cursor"):
+        st.session_state.cursors[conversation_id] = cursor
+        # The messages endpoint's ETag is the quoted cursor
+        st.session_state.etags[conversation_id] = f'"{cursor}"'
+    else:
+        fetch_new_messages(conversation_id)
+
+def add_message(conversation_id, message):
+    """Append a message to the conversation's cache unless a delta fetch already added it"""
+    cached = st.session_state.message_cache.setdefault(conversation_id, [])
+    if message["id"] not in {m.get("id") for m in cached}:
+        cached.append(message)
+
 # Authentication functions
 def login(username, password):
     """Authenticate user and get token"""
     try:
-        response = requests.post(
+        response = get_session().post(
             f"{API_URL}/token",
             data={"username": username, "password": password}
         )
         if response.status_code == 200:
             data = response.json()
             st.session_state.token = data["access_token"]
+            get_session().headers["Authorization"] = f"Bearer {st.session_state.token}"
             return True
         else:
             return False
@@ -45,10 +100,12 @@ def login(username, password):
         return False
 
 def get_conversations():
-    """Get user conversations"""
+    """Get user conversations, without their messages (those are fetched when one is opened)"""
     try:
-        headers = {"Authorization": f"Bearer {st.session_state.token}"}
-        response = requests.get(f"{API_URL}/api/conversations/", headers=headers)
+        response = get_session().get(
+            f"{API_URL}/api/conversations/",
+            params={"include_messages": "false"}
+        )
         if response.status_code == 200:
             return response.json()
         else:
@@ -58,23 +115,79 @@ def get_conversations():
         st.error(f"Error fetching conversations: {str(e)}")
         return []
 
+def fetch_new_messages(conversation_id):
+    """Fetch only messages newer than the last sync and append them to the local cache"""
+    try:
+        params = {}
+        headers = {}
+        if conversation_id in st.session_state.cursors:
+            params["after"] = st.session_state.cursors[conversation_id]
+        if conversation_id in st.session_state.etags:
+            headers["If-None-Match"] = st.session_state.etags[conversation_id]
+        
+        response = get_session().get(
+            f"{API_URL}/api/conversations/{conversation_id}/messages",
+            params=params,
+            headers=headers
+        )
+        if response.status_code == 304:
+            return []
+        if response.status_code != 200:
+            st.error(f"Error fetching messages: {response.status_code}")
+            return []
+        
+        data = response.json()
+        if data["cursor"]:
+            st.session_state.cursors[conversation_id] = data["cursor"]
+        if response.headers.get("ETag"):
+            st.session_state.etags[conversation_id] = response.headers["ETag"]
+        
+        # Messages added locally (our own sends) already carry their id
+        cached = st.session_state.message_cache.setdefault(conversation_id, [])
+        known_ids = {m.get("id") for m in cached}
+        new_messages = [m for m in data["messages"] if m["id"] not in known_ids]
+        cached.extend(new_messages)
+        
+        if data["has_more"]:
+            new_messages += fetch_new_messages(conversation_id)
+        return new_messages
+    except Exception as e:
+        st.error(f"Error fetching messages: {str(e)}")
+        return []
+
+def wait_for_reply(message_id, timeout=25, max_waits=6):
+    """Long-poll until the assistant reply to a user message is saved"""
+    for _ in range(max_waits):
+        try:
+            response = get_session().get(
+                f"{API_URL}/api/messages/{message_id}/reply",
+                params={"timeout": timeout},
+                timeout=timeout + 10
+            )
+        except Exception as e:
+            st.error(f"Error waiting for reply: {str(e)}")
+            return None
+        if response.status_code == 200:
+            reply = response.json()
+            advance_cursor(reply["conversation_id"], response)
+            add_message(reply["conversation_id"], reply)
+            return reply
+        if response.status_code != 204:
+            st.error(f"Error waiting for reply: {response.status_code}")
+            return None
+    return None
+
 def send_message(content, model_name):
     """Send message to API and get response"""
     try:
-        headers = {
-            "Authorization": f"Bearer {st.session_state.token}",
-            "Content-Type": "application/json"
-        }
-        
         data = {
             "content": content,
             "conversation_id": st.session_state.conversation_id,
             "model_name": model_name
         }
         
-        response = requests.post(
+        response = get_session().post(
             f"{API_URL}/api/messages/",
-            headers=headers,
             json=data
         )
         
@@ -82,6 +195,9 @@ def send_message(content, model_name):
             data = response.json()
             if not st.session_state.conversation_id:
                 st.session_state.conversation_id = data["conversation_id"]
+                st.session_state.message_cache[data["conversation_id"]] = st.session_state.messages
+            advance_cursor(data["conversation_id"], response)
+            add_message(data["conversation_id"], {"id": data["id"], "role": "user", "content": content})
             return data
         else:
             st.error(f"Error sending message: {response.status_code}")
@@ -116,31 +232,37 @@ with st.sidebar:
         model_options = ["gpt-3.5-turbo", "gpt-4", "claude-2"]
         selected_model = st.selectbox("Select Model", model_options)
         
-        # Conversation history
+        # Conversation history (cached until refreshed)
         st.subheader("Conversations")
         if st.button("Refresh Conversations"):
-            conversations = get_conversations()
-            
-            if conversations:
-                for conv in conversations:
-                    if st.button(f"{conv['title']} - {conv['created_at'][:10]}", key=conv["id"]):
-                        st.session_state.conversation_id = conv["id"]
-                        st.session_state.messages = conv["messages"]
-                        st.experimental_rerun()
-            else:
-                st.info("No conversations found")
+            st.session_state.conversations = [
+                {"id": conv["id"], "title": conv["title"], "created_at": conv["created_at"]}
+                for conv in get_conversations()
+            ]
+        
+        if st.session_state.conversations:
+            for conv in st.session_state.conversations:
+                if st.button(f"{conv['title']} - {conv['created_at'][:10]}", key=conv["id"]):
+                    open_conversation(conv["id"])
+                    fetch_new_messages(conv["id"])
+                    st.experimental_rerun()
+        elif st.session_state.conversations is not None:
+            st.info("No conversations found")
         
         # New conversation button
         if st.button("New Conversation"):
-            st.session_state.conversation_id = None
-            st.session_state.messages = []
+            open_conversation()
             st.experimental_rerun()
         
         # Logout button
         if st.button("Logout"):
             st.session_state.token = None
-            st.session_state.conversation_id = None
-            st.session_state.messages = []
+            get_session().headers.pop("Authorization", None)
+            st.session_state.conversations = None
+            st.session_state.message_cache = {}
+            st.session_state.cursors = {}
+            st.session_state.etags = {}
+            open_conversation()
             st.experimental_rerun()
 
 # Main chat interface
@@ -157,7 +279,6 @@ if st.session_state.token:  # Only show chat input if authenticated
     
     if user_input:
         # Add user message to chat
-        st.session_state.messages.append({"role": "user", "content": user_input})
         with st.chat_message("user"):
             st.write(user_input)
         
@@ -166,38 +287,15 @@ if st.session_state.token:  # Only show chat input if authenticated
             response = send_message(user_input, selected_model)
             
             if response:
-                # Check for assistant message in conversation (it's processed asynchronously)
-                time.sleep(1)  # Small delay to allow processing
-                
-                # Poll for assistant response
-                max_retries = 30
-                for i in range(max_retries):
-                    conversations = get_conversations()
-                    current_conv = next((c for c in conversations if c["id"] == st.session_state.conversation_id), None)
-                    
-                    if current_conv:
-                        messages = current_conv["messages"]
-                        # Find assistant message that comes after user message
-                        for j in range(len(messages)-1, 0, -1):
-                            if messages[j]["role"] == "assistant" and j > 0 and messages[j-1]["content"] == user_input:
-                                # Add assistant message to chat
-                                assistant_msg = messages[j]
-                                st.session_state.messages.append({
-                                    "role": "assistant", 
-                                    "content": assistant_msg["content"]
-                                })
-                                with st.chat_message("assistant"):
-                                    st.write(assistant_msg["content"])
-                                break
-                        else:
-                            # If assistant message not found, continue polling
-                            if i < max_retries - 1:
-                                time.sleep(1)
-                                continue
-                            else:
-                                st.error("No response received from assistant")
-                        break
+                # Wait for the assistant response (it's processed asynchronously) with one held request
+                reply = wait_for_reply(response["id"])
+                if reply:
+                    with st.chat_message("assistant"):
+                        st.write(reply["content"])
+                else:
+                    st.error("No response received from assistant")
             else:
+                st.session_state.messages.append({"role": "user", "content": user_input})
                 st.error("Failed to send message")
 else:
     st.info("Please login to start chatting")